@@ -0,0 +1,271 @@
+# bench.py
+# Load test / benchmark for main.py.
+#  - Starts a local Telegram Bot API stand-in (no network: getMe, setWebhook,
+#    sendMessage, editMessageText, ... all answered locally)
+#  - Runs `uvicorn main:app` in a subprocess against a temporary DB_PATH
+#  - Drives mixed traffic: webhook callback queries (watch_ad, confirm_ad:,
+#    balance, leaderboard), /v and /postback
+#  - Reports throughput and p50/p95/p99 latency per HTTP endpoint and per
+#    callback action (end to end: webhook POST -> editMessageText received)
+#  - Writes the results as JSON and compares them with a baseline run
+# Usage:
+#   python bench.py --duration 30 --concurrency 32 --out bench.json
+#   python bench.py --baseline bench.json --out bench-new.json --max-regression 20
+
+import os, sys, json, time, random, socket, asyncio, argparse, tempfile, platform, subprocess, itertools
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+BENCH_TOKEN = "123456:BENCH-token"
+BENCH_ADMIN_ID = 1
+DEFAULT_MIX = "balance=30,leaderboard=25,watch_ad=10,confirm_ad=15,v=10,postback=10"
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def percentile(sorted_vals, p:float) -> float:
+    # nearest-rank
+    if not sorted_vals: return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+def summarize(samples, errors:int, elapsed:float):
+    vals = sorted(samples)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "count": len(vals), "errors": errors,
+        "throughput_rps": round(len(vals) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": ms(percentile(vals, 50)), "p95_ms": ms(percentile(vals, 95)), "p99_ms": ms(percentile(vals, 99)),
+        "mean_ms": ms(sum(vals) / len(vals)) if vals else 0.0, "max_ms": ms(vals[-1]) if vals else 0.0,
+    }
+
+# -------------------------
+# Fake Bot API
+# -------------------------
+class FakeBotAPI:
+    def __init__(self):
+        self.app = FastAPI()
+        self.calls = defaultdict(int)
+        self.waiters = {}       # (chat_id, message_id) -> Future resolved on editMessageText
+        self.webhook_set = asyncio.Event()
+        self.app.add_api_route("/bot{token}/{method}", self.handle, methods=["GET", "POST"])
+
+    def expect_edit(self, chat_id:int, message_id:int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[(chat_id, message_id)] = fut
+        return fut
+
+    async def handle(self, token:str, method:str, request: Request):
+        self.calls[method] += 1
+        # PTB posts url-encoded forms (no multipart dependency needed here)
+        p = dict(request.query_params)
+        body = await request.body()
+        if body:
+            p.update(json.loads(body) if body[:1] == b"{" else parse_qsl(body.decode()))
+        if method == "getMe":
+            return self.ok({"id": 123456, "is_bot": True, "first_name": "Earnly", "username": "earnly_bench_bot"})
+        if method in ("setWebhook", "deleteWebhook"):
+            if method == "setWebhook": self.webhook_set.set()
+            return self.ok(True)
+        if method == "getWebhookInfo":
+            return self.ok({"url": "", "has_custom_certificate": False, "pending_update_count": 0})
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(p.get("chat_id", 0)); message_id = int(p.get("message_id", 1))
+            if method == "editMessageText":
+                fut = self.waiters.pop((chat_id, message_id), None)
+                if fut is not None and not fut.done(): fut.set_result(time.perf_counter())
+            return self.ok({"message_id": message_id, "date": int(time.time()),
+                            "chat": {"id": chat_id, "type": "private"}, "text": p.get("text", "")})
+        return self.ok(True)
+
+    @staticmethod
+    def ok(result):
+        return JSONResponse({"ok": True, "result": result})
+
+# -------------------------
+# Traffic
+# -------------------------
+class Bench:
+    def __init__(self, args, base:str, api:FakeBotAPI):
+        self.args = args; self.base = base; self.api = api
+        self.endpoint = defaultdict(list); self.endpoint_err = defaultdict(int)
+        self.action = defaultdict(list); self.action_err = defaultdict(int)
+        self.ids = itertools.count(1)
+        mix = dict(kv.split("=") for kv in args.mix.split(","))
+        self.kinds = list(mix); self.weights = [float(mix[k]) for k in self.kinds]
+        self.client = httpx.AsyncClient(base_url=base, timeout=args.timeout, follow_redirects=False,
+                                        limits=httpx.Limits(max_connections=args.concurrency * 2))
+
+    async def http(self, name:str, method:str, url:str, **kw):
+        t0 = time.perf_counter()
+        try:
+            r = await self.client.request(method, url, **kw)
+            ok = r.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        if ok: self.endpoint[name].append(time.perf_counter() - t0)
+        else: self.endpoint_err[name] += 1
+        return ok
+
+    def callback_update(self, uid:int, data:str, message_id:int) -> dict:
+        uid_ = next(self.ids)
+        return {"update_id": uid_, "callback_query": {
+            "id": str(uid_), "chat_instance": "bench", "data": data,
+            "from": {"id": uid, "is_bot": False, "first_name": "Bench"},
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "text": "menu"}}}
+
+    async def callback(self, uid:int, data:str):
+        action = data.split(":", 1)[0]
+        message_id = next(self.ids)
+        fut = self.api.expect_edit(uid, message_id)
+        t0 = time.perf_counter()
+        ok = await self.http("/webhook/{token}", "POST", f"/webhook/{BENCH_TOKEN}", json=self.callback_update(uid, data, message_id))
+        try:
+            if not ok: raise asyncio.TimeoutError
+            done = await asyncio.wait_for(fut, self.args.timeout)
+            self.action[action].append(done - t0)
+        except asyncio.TimeoutError:
+            self.api.waiters.pop((uid, message_id), None)
+            self.action_err[action] += 1
+
+    async def one(self, uid:int):
+        kind = random.choices(self.kinds, self.weights)[0]
+        if kind in ("balance", "leaderboard", "watch_ad"):
+            await self.callback(uid, kind)
+        elif kind == "confirm_ad":
+            token = f"b{next(self.ids)}"
+            await self.http("/v", "GET", "/v", params={"t": token, "user": uid})
+            await self.callback(uid, f"confirm_ad:{token}")
+        elif kind == "v":
+            await self.http("/v", "GET", "/v", params={"t": f"b{next(self.ids)}", "user": uid})
+        elif kind == "postback":
+            await self.http("/postback", "GET", "/postback", params={"subid": uid, "amount": 0.05, "txid": f"bench-{next(self.ids)}"})
+
+    async def worker(self, deadline:float):
+        while time.perf_counter() < deadline:
+            await self.one(random.randint(1000, 1000 + self.args.users - 1))
+
+    async def run(self):
+        deadline = time.perf_counter() + self.args.warmup
+        await asyncio.gather(*(self.worker(deadline) for _ in range(self.args.concurrency)))
+        self.endpoint.clear(); self.endpoint_err.clear(); self.action.clear(); self.action_err.clear()
+        calls_before = dict(self.api.calls)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(self.worker(t0 + self.args.duration) for _ in range(self.args.concurrency)))
+        elapsed = time.perf_counter() - t0
+        await self.client.aclose()
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "endpoints": {k: summarize(self.endpoint[k], self.endpoint_err[k], elapsed) for k in sorted(set(self.endpoint) | set(self.endpoint_err))},
+            "actions": {k: summarize(self.action[k], self.action_err[k], elapsed) for k in sorted(set(self.action) | set(self.action_err))},
+            "bot_api_calls": {k: v - calls_before.get(k, 0) for k, v in sorted(self.api.calls.items())},
+        }
+
+# -------------------------
+# Baseline comparison
+# -------------------------
+def compare(result:dict, baseline:dict, max_regression:float):
+    # prints a table; returns the list of metrics whose p95 or throughput regressed too far
+    regressions = []
+    print(f"\n{'metric':<34}{'base p95':>10}{'new p95':>10}{'Δp95':>9}{'base rps':>10}{'new rps':>10}{'Δrps':>9}")
+    for group in ("endpoints", "actions"):
+        for name, new in result[group].items():
+            old = baseline.get(group, {}).get(name)
+            if not old: continue
+            dp95 = (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+            drps = (new["throughput_rps"] - old["throughput_rps"]) / old["throughput_rps"] * 100 if old["throughput_rps"] else 0.0
+            label = f"{group[:-1]}:{name}"
+            print(f"{label:<34}{old['p95_ms']:>10.2f}{new['p95_ms']:>10.2f}{dp95:>8.1f}%{old['throughput_rps']:>10.1f}{new['throughput_rps']:>10.1f}{drps:>8.1f}%")
+            if dp95 > max_regression or -drps > max_regression:
+                regressions.append(label)
+    return regressions
+
+def print_result(result:dict):
+    for group in ("endpoints", "actions"):
+        print(f"\n{group}:")
+        for name, m in result[group].items():
+            print(f"  {name:<20} n={m['count']:<7} err={m['errors']:<4} {m['throughput_rps']:>8.1f} rps  "
+                  f"p50 {m['p50_ms']:.2f}  p95 {m['p95_ms']:.2f}  p99 {m['p99_ms']:.2f} ms")
+    print(f"\nBot API calls: {result['bot_api_calls']}")
+
+def git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+# -------------------------
+# Main
+# -------------------------
+async def main(args):
+    random.seed(args.seed)
+    api = FakeBotAPI()
+    api_port = free_port(); app_port = free_port()
+    api_server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=api_port, log_level="warning", access_log=False))
+    api_task = asyncio.create_task(api_server.serve())
+
+    tmp = tempfile.mkdtemp(prefix="earnly-bench-")
+    env = dict(os.environ,
+               DB_PATH=os.path.join(tmp, "bench.db"), BOT_TOKEN=BENCH_TOKEN, ADMIN_ID=str(BENCH_ADMIN_ID),
+               BASE_URL=f"http://127.0.0.1:{app_port}", TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+               WAIT_SECONDS="0", MAX_ADS_PER_DAY="1000000",
+               # a few simulated users generate the traffic of many: lift the abuse limits
+               RL_V_PER_USER="0/60", RL_V_PER_IP="0/60", RL_CALLBACK_PER_USER="0/60", VELOCITY_FLAG_SCORE="1e12")
+    if args.workers > 1: env["WEB_CONCURRENCY"] = str(args.workers)
+    for kv in args.env:
+        k, v = kv.split("=", 1); env[k] = v
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+                             "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"], cwd=here, env=env)
+    try:
+        await asyncio.wait_for(api.webhook_set.wait(), 30)
+        bench = Bench(args, f"http://127.0.0.1:{app_port}", api)
+        result = await bench.run()
+    finally:
+        proc.terminate()
+        # wait off the loop: the app's shutdown still talks to the Bot API stand-in
+        try: await asyncio.to_thread(proc.wait, 15)
+        except subprocess.TimeoutExpired: proc.kill()
+        api_server.should_exit = True
+        await api_task
+
+    result["meta"] = {
+        "git_rev": git_rev(), "timestamp": int(time.time()), "python": platform.python_version(),
+        "platform": platform.platform(), "duration_s": args.duration, "warmup_s": args.warmup,
+        "concurrency": args.concurrency, "workers": args.workers, "users": args.users, "mix": args.mix, "seed": args.seed, "env": args.env,
+    }
+    print_result(result)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print(f"\nResults written to {args.out}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            print(f"\nRegressed more than {args.max_regression}%: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Earnly bot load test against a local Bot API stand-in")
+    ap.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    ap.add_argument("--warmup", type=float, default=3.0, help="unmeasured seconds before the run")
+    ap.add_argument("--concurrency", type=int, default=32, help="concurrent virtual clients")
+    ap.add_argument("--users", type=int, default=500, help="distinct Telegram user ids")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="traffic weights, e.g. balance=30,v=10")
+    ap.add_argument("--timeout", type=float, default=10.0, help="per-request timeout (s)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    ap.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the app process")
+    ap.add_argument("--out", default="bench.json")
+    ap.add_argument("--baseline", help="previous results JSON to compare with")
+    ap.add_argument("--max-regression", type=float, default=20.0, help="percent; exit 1 above it")
+    sys.exit(asyncio.run(main(ap.parse_args())))
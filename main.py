@@ -4,36 +4,53 @@
 # Full features as requested:
 #  - Task before reward: tracking /v?t=... & wait >= WAIT_SECONDS
 #  - Max 10 ads/day, daily reset
-#  - Referral $0.001 per valid /start <id> (no self-ref)
+#  - Referral $0.001 per new user joining via /start <id> (once, no self-ref); 2-level referral stats
 #  - Daily bonus $0.001 once/day
 #  - Offerwall integration (hard-coded direct link w/ subid)
-#  - /postback endpoint to credit offerwall via provider
+#  - /postback endpoint to credit offerwall via provider (GET single, signed POST bulk; txid required, idempotent on it)
 #  - Withdraw requests + admin Approve/Reject
-#  - Admin commands: /admin_broadcast, /admin_stats
+#  - Admin commands: /admin_broadcast (background, resumable), /admin_broadcast_cancel, /admin_stats,
+#    /admin_leaderboard_check, /admin_approve_under <usd>, /admin_reconcile [repair], /admin_rebuild_referrals
+#  - Withdraw review queue in the Admin Panel (paged, approve page / all under $X)
 #  - Leaderboard, Earnly Website button (coming soon)
+#  - Prometheus /metrics (route, button, DB helper, Bot API latency) and /debug/profile sampler
+#  - Streaming CSV/NDJSON exports of transactions, withdraws and users (/admin/export/...)
 #  - Top-of-chat UX via edit_message_text
 #  - SQLite persistence (no balance loss)
 #  - Micro-units: 1 micro = $0.001
 #  - Basic anti-cheat: click token tracking & wait-time
 # Use with uvicorn main:app --host 0.0.0.0 --port $PORT
 
-import os, sqlite3, asyncio, json, time, secrets
-from datetime import datetime, date
+import os, sys, io, math, sqlite3, asyncio, json, time, secrets, hmac, hashlib, threading, functools, queue, contextvars, bisect
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, date, timedelta, timezone
 from typing import Optional
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import RedirectResponse, PlainTextResponse, JSONResponse
+from collections import OrderedDict, Counter, deque
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import RedirectResponse, PlainTextResponse, JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 load_dotenv()
 
+try:
+    import orjson    # optional: ~3-5x faster webhook decoding
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, ExtBot, BaseUpdateProcessor
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, NetworkError
 
 # -------------------------
 # CONFIG (env or defaults)
 # -------------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8458909740:AAFxZQCcuzMGZctsbo_AG4RmTmf-5L8YvRs")
 BASE_URL = os.getenv("BASE_URL", "https://earnly-bot.onrender.com")  # your Render url
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")  # bench.py points this at a local stand-in
 ADMIN_ID = int(os.getenv("ADMIN_ID", os.getenv("MY_ADMIN_ID", "7589508564")))  # your admin id
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")  # admin HTTP routes (/metrics, /debug/*); unset = disabled
+POSTBACK_SECRET = os.getenv("POSTBACK_SECRET", "")  # signs bulk POST /postback bodies; unset = bulk route disabled
 
 # Offerwall hard-coded direct link (we append subid=user_id)
 OFFERWALL_DIRECT = "https://zwidgetymz56r.xyz/list/zCMQAYfI"
@@ -47,18 +64,529 @@ MAX_ADS_PER_DAY = int(os.getenv("MAX_ADS_PER_DAY", "10"))
 WAIT_SECONDS = int(os.getenv("WAIT_SECONDS", "30"))
 
 DB_PATH = os.getenv("DB_PATH", "earnly.db")
+STORAGE = os.getenv("STORAGE", "sqlite")   # sqlite (file, WAL) | memory (per-process, tests/benchmarks)
+
+# Several workers: set WEB_CONCURRENCY=N (uvicorn also reads it as its --workers
+# default) or MULTI_WORKER=1. One worker leads (webhook, jobs), and per-process
+# caches that other workers' writes would make stale are off. A plain
+# `uvicorn --workers N` doesn't tell the workers; they notice each other through
+# lock files instead and switch within LEADER_POLL_SECONDS (see enable_multi_worker).
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+MULTI_WORKER = WEB_CONCURRENCY > 1 or os.getenv("MULTI_WORKER", "0") == "1"
+
+# -------------------------
+# Metrics
+# -------------------------
+# Hand-rolled Prometheus text exposition (GET /metrics): latency histograms per
+# HTTP route, per update/button action, per DB helper and per Bot API method,
+# plus gauges read at scrape time (queue depths, cache sizes). An observation
+# is a bisect and three additions under an uncontended lock, cheap enough to
+# leave on; METRICS_ENABLED=0 turns it off entirely.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _prom_labels(names, values) -> str:
+    if not names: return ""
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+class Histogram:
+    def __init__(self, name:str, help:str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name; self.help = help; self.labels = tuple(labels); self.buckets = tuple(buckets)
+        self._series = {}   # label values -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds:float):
+        if not METRICS_ENABLED: return
+        if not isinstance(key, tuple): key = (key,)
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1; s[-1] += seconds
+
+    def render(self, out:list):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        with self._lock:
+            series = [(k, list(s)) for k, s in self._series.items()]
+        for key, s in sorted(series):
+            acc = 0
+            for le, n in zip(self.buckets + ("+Inf",), s):
+                acc += n
+                out.append(f"{self.name}_bucket{_prom_labels(self.labels + ('le',), key + (le,))} {acc}")
+            lbl = _prom_labels(self.labels, key)
+            out.append(f"{self.name}_sum{lbl} {s[-1]:.6f}")
+            out.append(f"{self.name}_count{lbl} {acc}")
+
+class CounterMetric:
+    def __init__(self, name:str, help:str, labels=()):
+        self.name = name; self.help = help; self.labels = tuple(labels)
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, key=(), n:int=1):
+        if not METRICS_ENABLED: return
+        if not isinstance(key, tuple): key = (key,)
+        with self._lock:
+            self._values[key] += n
+
+    def render(self, out:list):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} counter")
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, v in values:
+            out.append(f"{self.name}{_prom_labels(self.labels, key)} {v}")
+
+class GaugeMetric:
+    # value(s) read at scrape time: fn() returns a number or {label value: number}
+    def __init__(self, name:str, help:str, fn, label:Optional[str]=None, kind:str="gauge"):
+        self.name = name; self.help = help; self.fn = fn; self.label = label; self.kind = kind
+
+    def render(self, out:list):
+        try:
+            v = self.fn()
+        except Exception:
+            return
+        if v is None: return
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        if isinstance(v, dict):
+            for k, n in sorted(v.items()):
+                out.append(f"{self.name}{_prom_labels((self.label,), (k,))} {n}")
+        else:
+            out.append(f"{self.name} {v}")
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self.add(CounterMetric(name, help, labels))
+
+    def gauge(self, name, help, fn, label=None, kind="gauge"):
+        return self.add(GaugeMetric(name, help, fn, label, kind))
+
+    def render(self) -> str:
+        out = []
+        for m in self._metrics:
+            m.render(out)
+        return "\n".join(out) + "\n"
+
+metrics = MetricsRegistry()
+http_seconds = metrics.histogram("earnly_http_request_seconds", "HTTP request latency by route.", ("method", "route"))
+http_responses = metrics.counter("earnly_http_responses_total", "HTTP responses by route and status.", ("route", "status"))
+update_seconds = metrics.histogram("earnly_update_seconds", "Update handling latency by action (button or command).", ("action",))
+update_errors = metrics.counter("earnly_update_errors_total", "Updates whose handler raised, by action.", ("action",))
+db_seconds = metrics.histogram("earnly_db_seconds", "DB helper execution time (reads on the pool, writes inside the writer batch).", ("helper", "kind"))
+db_errors = metrics.counter("earnly_db_errors_total", "DB helper calls that raised.", ("helper", "kind"))
+db_commit_seconds = metrics.histogram("earnly_db_commit_seconds", "Group-commit batch duration (BEGIN to COMMIT).")
+bot_api_seconds = metrics.histogram("earnly_bot_api_seconds", "Telegram Bot API call latency by method.", ("method",))
+bot_api_errors = metrics.counter("earnly_bot_api_errors_total", "Telegram Bot API errors by method and error type.", ("method", "error"))
+
+class MetricsMiddleware:
+    # plain ASGI middleware (no BaseHTTPMiddleware task/stream overhead); routes
+    # are labelled by their template, so /webhook/{token} never leaks the token
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter(); status = [500]
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start": status[0] = message["status"]
+            await send(message)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_seconds.observe((scope["method"], route), time.perf_counter() - t0)
+            http_responses.inc((route, status[0]))
+
+# -------------------------
+# Sampling profiler
+# -------------------------
+# On demand only (GET /debug/profile?seconds=N, needs ADMIN_API_KEY): a thread
+# snapshots every thread's stack via sys._current_frames() each
+# PROFILE_INTERVAL_MS and returns the hottest stacks in collapsed
+# "frame;frame;frame count" form (feed it to flamegraph.pl / speedscope as is).
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MAX_DEPTH = 40
+
+_profile_lock = threading.Lock()
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+# leaf frames of threads parked waiting for work (queue/executor/selector)
+_IDLE_FRAMES = {"wait", "select", "poll", "_worker"}
+
+def sample_stacks(seconds:float, interval:float=PROFILE_INTERVAL_MS / 1000, idle:bool=False):
+    # blocking; returns (Counter of collapsed stacks, samples taken)
+    me = threading.get_ident()
+    names = {}
+    stacks = Counter(); samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for tid, frame in sys._current_frames().items():
+            if tid == me: continue
+            if not idle and frame.f_code.co_name in _IDLE_FRAMES: continue
+            parts = []
+            while frame is not None and len(parts) < PROFILE_MAX_DEPTH:
+                parts.append(_frame_label(frame)); frame = frame.f_back
+            if tid not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            parts.append(names.get(tid, str(tid)))
+            stacks[";".join(reversed(parts))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def profile_report(stacks:Counter, samples:int, top:int=200) -> str:
+    # leaf-function summary first, then the collapsed stacks
+    leaves = Counter()
+    for stack, n in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += n
+    total = sum(leaves.values())
+    lines = [f"# {samples} samples every {PROFILE_INTERVAL_MS}ms, {total} busy thread stacks",
+             "# hottest frames (stacks, % of busy stacks):"]
+    for leaf, n in leaves.most_common(25):
+        lines.append(f"#  {n:6d} {n / max(total, 1):6.1%}  {leaf}")
+    lines.append("# collapsed stacks:")
+    lines.extend(f"{stack} {n}" for stack, n in stacks.most_common(top))
+    return "\n".join(lines) + "\n"
+
+# -------------------------
+# Storage
+# -------------------------
+# Where the helpers' connections come from. Both backends speak SQLite SQL, so
+# every helper, migration and query plan check works unchanged on either:
+#  - SQLiteStorage: the DB_PATH file in WAL mode; several processes can share it.
+#  - MemoryStorage: an in-memory database private to this process (shared cache
+#    so all of its threads see the same data), for tests and benchmarks.
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+class SQLiteStorage:
+    name = "sqlite"
+    multi_process = True
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def connect(self, synchronous="NORMAL", isolation_level=""):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               isolation_level=isolation_level)
+        conn.row_factory = sqlite3.Row
+        # WAL: readers never wait on the writer; NORMAL sync is safe in WAL mode
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")      # ~16MB page cache per connection
+        conn.execute("PRAGMA mmap_size=268435456")    # 256MB memory-mapped reads
+        return conn
+
+    def leader_lock_path(self) -> Optional[str]:
+        return self.path + ".leader"
+
+    def close(self):
+        pass
+
+class MemoryStorage:
+    name = "memory"
+    multi_process = False
+
+    def __init__(self, name:str="earnly"):
+        self.uri = f"file:{name}-{os.getpid()}-{id(self)}?mode=memory&cache=shared"
+        # the database lives as long as one connection to it is open
+        self._anchor = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+
+    def connect(self, synchronous="NORMAL", isolation_level=""):
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               isolation_level=isolation_level)
+        conn.row_factory = sqlite3.Row
+        # shared-cache readers would otherwise take table locks that fail at once
+        # (busy_timeout doesn't cover them) while the writer holds its batch open;
+        # the price is that pool reads may see a batch before it commits
+        conn.execute("PRAGMA read_uncommitted=1")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def leader_lock_path(self) -> Optional[str]:
+        return None     # nothing to share with other processes
+
+    def close(self):
+        if self._anchor is not None:
+            self._anchor.close(); self._anchor = None
+
+def make_storage(kind:str=STORAGE):
+    if kind == "sqlite": return SQLiteStorage(DB_PATH)
+    if kind == "memory": return MemoryStorage()
+    raise ValueError(f"unknown STORAGE {kind!r} (sqlite | memory)")
+
+storage = make_storage()
+if MULTI_WORKER and not storage.multi_process:
+    raise RuntimeError(f"STORAGE={storage.name} is per-process; multi-worker deployments need STORAGE=sqlite")
 
 # -------------------------
 # DB helpers (sqlite)
 # -------------------------
+# Every thread keeps one long-lived connection from `storage`. The async
+# versions of the helpers (a*) run on a small dedicated executor, so the pool is
+# DB_POOL_SIZE connections that never block the event loop.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+_db_local = threading.local()
+_db_conns = []
+_db_conns_lock = threading.Lock()
+DB_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+def _open_conn(synchronous="NORMAL", isolation_level=""):
+    conn = storage.connect(synchronous=synchronous, isolation_level=isolation_level)
+    with _db_conns_lock:
+        _db_conns.append(conn)
+    return conn
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # long-lived per-thread connection (do not close it)
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _open_conn(); _db_local.conn = conn
     return conn
 
-def init_db():
-    conn = get_conn(); c = conn.cursor()
-    c.executescript("""
+def _db_executor():
+    global DB_EXECUTOR
+    if DB_EXECUTOR is None:
+        DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="earnly-db",
+                                         initializer=get_conn)
+    return DB_EXECUTOR
+
+def _timed_call(fn, args, kwargs):
+    # runs on a pool thread: times the helper itself, not the executor queue wait
+    t0 = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        db_errors.inc((fn.__name__, "pool")); raise
+    finally:
+        db_seconds.observe((fn.__name__, "pool"), time.perf_counter() - t0)
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor(), _timed_call, fn, args, kwargs)
+
+def _awaitable(fn):
+    # async twin of a sync helper: reads run on the DB pool, write ops go to the writer
+    tx = getattr(fn, "_tx", None)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if tx is not None:
+            return await db_writer.run(tx, *args, **kwargs)
+        return await run_db(fn, *args, **kwargs)
+    wrapper.__name__ = wrapper.__qualname__ = "a" + fn.__name__
+    return wrapper
+
+def close_db():
+    # closes this process' connections; MemoryStorage keeps its data until storage.close()
+    global DB_EXECUTOR
+    if DB_EXECUTOR is not None:
+        DB_EXECUTOR.shutdown(wait=True); DB_EXECUTOR = None
+    with _db_conns_lock:
+        conns = list(_db_conns); _db_conns.clear()
+    if db_writer.running:
+        # stop() gave up on it: the writer may still be inside a commit
+        conns = [c for c in conns if c is not db_writer._conn]
+    for conn in conns:
+        try: conn.close()
+        except Exception: pass
+    _db_local.__dict__.clear()
+
+# -------------------------
+# Group-commit writer
+# -------------------------
+# All writes go through one background thread that owns the write connection.
+# Queued ops are committed together (up to DB_WRITE_BATCH ops or
+# DB_WRITE_DELAY_MS after the first one), so a burst of clicks/credits costs one
+# fsync instead of one each. Every op runs in its own SAVEPOINT: a failing op is
+# rolled back alone and its caller gets the exception. Futures resolve only
+# after COMMIT, i.e. once the write is durable (synchronous=FULL).
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "256"))
+DB_WRITE_DELAY_MS = float(os.getenv("DB_WRITE_DELAY_MS", "5"))
+
+_tx_local = threading.local()
+
+def after_commit(fn, *args):
+    # from inside a write op: run fn(*args) once the op is committed (dropped if
+    # it rolls back). In-process caches are updated this way.
+    hooks = getattr(_tx_local, "hooks", None)
+    if hooks is None:
+        fn(*args)
+    else:
+        hooks.append((fn, args))
+
+class DBWriter:
+    def __init__(self, max_batch:int=DB_WRITE_BATCH, max_delay_ms:float=DB_WRITE_DELAY_MS):
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self._q = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._conn = None
+        self._inline_lock = threading.Lock()
+        self.batches = 0; self.ops = 0; self.failed_ops = 0
+        self.max_batch_seen = 0; self.max_queue_depth = 0; self.last_commit_ms = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread: return
+        self._thread = threading.Thread(target=self._run, name="earnly-db-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout:float=10.0) -> bool:
+        # everything queued before stop() is still committed; False if the
+        # thread didn't finish within timeout (it keeps its connection then)
+        if self._thread:
+            self._q.put(None); self._thread.join(timeout)
+            if self._thread.is_alive():
+                print(f"DB writer still busy after {timeout:.1f}s, abandoning {max(0, self._q.qsize() - 1)} queued ops")
+                return False
+            self._thread = None
+        if self._conn is not None:
+            self._conn.close(); self._conn = None
+        return True
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        # fn(c, *args, **kwargs) is a transaction body; returns a concurrent Future
+        fut = Future()
+        item = (fn, args, kwargs, fut)
+        if self._thread is None:
+            # no writer thread (scripts, before startup): commit inline
+            with self._inline_lock:
+                self._commit([item])
+            return fut
+        self._q.put(item)
+        depth = self._q.qsize()
+        if depth > self.max_queue_depth: self.max_queue_depth = depth
+        return fut
+
+    def call(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stats(self):
+        return {
+            "queue_depth": self._q.qsize(), "max_queue_depth": self.max_queue_depth,
+            "batches": self.batches, "ops": self.ops, "failed_ops": self.failed_ops,
+            "avg_batch": round(self.ops / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch_seen, "last_commit_ms": round(self.last_commit_ms, 3),
+        }
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = _open_conn(synchronous="FULL", isolation_level=None)
+        return self._conn
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is None: break
+            batch = [item]; stop = False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._q.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0: break
+                    try: item = self._q.get(timeout=timeout)
+                    except queue.Empty: break
+                if item is None: stop = True; break
+                batch.append(item)
+            self._commit(batch)
+            if stop: break
+
+    def _commit(self, batch):
+        conn = self._connection()
+        t0 = time.perf_counter()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, kwargs, fut in batch:
+                conn.execute("SAVEPOINT op")
+                _tx_local.hooks = []
+                t_op = time.perf_counter()
+                try:
+                    res = fn(conn.cursor(), *args, **kwargs)
+                    conn.execute("RELEASE op")
+                    results.append((fut, res, None, _tx_local.hooks))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op"); conn.execute("RELEASE op")
+                    results.append((fut, None, e, ()))
+                    db_errors.inc((fn.__name__, "writer"))
+                db_seconds.observe((fn.__name__, "writer"), time.perf_counter() - t_op)
+            _tx_local.hooks = None
+            conn.execute("COMMIT")
+        except Exception as e:
+            _tx_local.hooks = None
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self.failed_ops += len(batch)
+            for _, _, _, fut in batch:
+                fut.set_exception(e)
+            return
+        elapsed = time.perf_counter() - t0
+        self.last_commit_ms = elapsed * 1000
+        db_commit_seconds.observe((), elapsed)
+        self.batches += 1; self.ops += len(batch)
+        if len(batch) > self.max_batch_seen: self.max_batch_seen = len(batch)
+        for fut, res, err, hooks in results:
+            for hook, args in hooks:
+                try: hook(*args)
+                except Exception as e: print("after_commit hook failed:", e)
+            if err is not None:
+                self.failed_ops += 1; fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+db_writer = DBWriter()
+
+def write_op(tx):
+    # tx(c, *args) is a transaction body; calling the helper queues it on the writer
+    @functools.wraps(tx)
+    def helper(*args, **kwargs):
+        return db_writer.call(tx, *args, **kwargs)
+    helper._tx = tx
+    return helper
+
+# -------------------------
+# Schema migrations
+# -------------------------
+# (version, description, sql or fn(conn)). Applied in order at startup, each in
+# its own BEGIN IMMEDIATE transaction that re-checks the version first, so
+# several processes starting at once apply every step exactly once. Never edit
+# a shipped migration: append a new one.
+MIGRATIONS = [
+    (1, "baseline schema", """
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
         username TEXT,
@@ -93,123 +621,1166 @@ def init_db():
         amount_micro INTEGER,
         created_at INTEGER
     );
-    """)
-    conn.commit(); conn.close()
+    CREATE TABLE IF NOT EXISTS ad_claims (
+        user_id INTEGER,
+        token TEXT,
+        claimed_at INTEGER,
+        PRIMARY KEY (user_id, token)
+    );
+    """),
+    (2, "hot-path indexes + unique click tokens", """
+    -- keep only the latest click per (user, token) so the unique index can be built
+    DELETE FROM clicks WHERE id NOT IN (SELECT MAX(id) FROM clicks GROUP BY user_id, token);
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_clicks_user_token ON clicks(user_id, token);
+    CREATE INDEX IF NOT EXISTS idx_withdraws_status ON withdraws(status, id, user_id, amount_micro, requested_at);
+    CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance_micro DESC, user_id);
+    """),
+    (3, "broadcast jobs + per-recipient progress", """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT DEFAULT 'running',
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        cursor_user_id INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        created_at INTEGER,
+        finished_at INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT,
+        sent_at INTEGER,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID;
+    """),
+    (4, "click retention: daily click aggregates", """
+    CREATE TABLE IF NOT EXISTS click_daily (
+        user_id INTEGER,
+        day TEXT,
+        clicks INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_ad_claims_time ON ad_claims(claimed_at);
+    """),
+    (5, "idempotent offerwall postbacks", """
+    CREATE TABLE IF NOT EXISTS postbacks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        txid TEXT NOT NULL,
+        user_id INTEGER,
+        amount_micro INTEGER,
+        user_share_micro INTEGER,
+        created_at INTEGER
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_postbacks_txid ON postbacks(txid);
+    """),
+    (6, "pre-aggregated stats: running counters + daily totals per transaction type", """
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT,
+        type TEXT,
+        count INTEGER DEFAULT 0,
+        amount_micro INTEGER DEFAULT 0,
+        PRIMARY KEY (day, type)
+    ) WITHOUT ROWID;
+    -- backfill from the existing rows; from here on writes keep them current
+    INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users;
+    INSERT OR REPLACE INTO stats_counters (name, value)
+        SELECT 'withdraws_' || status, COUNT(*) FROM withdraws WHERE status IN ('pending', 'approved', 'rejected') GROUP BY status;
+    INSERT OR REPLACE INTO stats_counters (name, value)
+        SELECT 'withdraws_' || status || '_micro', COALESCE(SUM(amount_micro), 0) FROM withdraws WHERE status IN ('pending', 'approved') GROUP BY status;
+    INSERT OR REPLACE INTO stats_daily (day, type, count, amount_micro)
+        SELECT date(created_at, 'unixepoch'), type, COUNT(*), COALESCE(SUM(amount_micro), 0) FROM transactions GROUP BY 1, 2;
+    """),
+    (7, "ledger export: transactions by time", """
+    CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at);
+    """),
+    (8, "ledger completeness + reconciliation state", """
+    -- approved withdraws used to deduct balance_micro without a ledger row
+    INSERT INTO transactions (user_id, type, amount_micro, created_at)
+        SELECT user_id, 'withdraw', -amount_micro, requested_at FROM withdraws WHERE status = 'approved' ORDER BY id;
+    INSERT OR REPLACE INTO stats_daily (day, type, count, amount_micro)
+        SELECT date(requested_at, 'unixepoch'), 'withdraw', COUNT(*), -SUM(amount_micro) FROM withdraws WHERE status = 'approved' GROUP BY 1;
+    -- ad/offer/referral credits used to land only in their sub-balance, never in the total
+    UPDATE users SET balance_micro = balance_micro + ad_balance_micro + offer_balance_micro + referral_balance_micro
+        WHERE ad_balance_micro + offer_balance_micro + referral_balance_micro != 0;
+    -- per-user sums of the ledger up to recon_state.ledger_tx_id (maintained by reconcile())
+    CREATE TABLE IF NOT EXISTS ledger_balances (
+        user_id INTEGER PRIMARY KEY,
+        balance_micro INTEGER DEFAULT 0,
+        ad_balance_micro INTEGER DEFAULT 0,
+        offer_balance_micro INTEGER DEFAULT 0,
+        referral_balance_micro INTEGER DEFAULT 0,
+        total_earned_micro INTEGER DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS recon_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER
+    ) WITHOUT ROWID;
+    """),
+    (9, "referral graph: one edge per referee + per-referrer aggregates", """
+    CREATE TABLE IF NOT EXISTS referrals (
+        referee_id INTEGER PRIMARY KEY,
+        referrer_id INTEGER NOT NULL,
+        created_at INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
+    CREATE TABLE IF NOT EXISTS referral_stats (
+        user_id INTEGER PRIMARY KEY,
+        direct_count INTEGER DEFAULT 0,
+        depth2_count INTEGER DEFAULT 0,
+        earnings_micro INTEGER DEFAULT 0
+    );
+    -- edges for users that already carry a referrer (counts bumped before this have none)
+    INSERT OR IGNORE INTO referrals (referee_id, referrer_id, created_at)
+        SELECT u.user_id, u.referred_by, NULL FROM users u
+        WHERE u.referred_by IS NOT NULL AND u.referred_by != u.user_id
+          AND EXISTS (SELECT 1 FROM users r WHERE r.user_id = u.referred_by);
+    INSERT INTO referral_stats (user_id, direct_count, earnings_micro)
+        SELECT r.referrer_id, COUNT(*), COALESCE(SUM(u.total_earned_micro), 0)
+        FROM referrals r LEFT JOIN users u ON u.user_id = r.referee_id GROUP BY r.referrer_id;
+    UPDATE referral_stats SET depth2_count = (SELECT COUNT(*) FROM referrals r1 JOIN referrals r2 ON r2.referrer_id = r1.referee_id
+        WHERE r1.referrer_id = referral_stats.user_id);
+    """),
+    (10, "referral stats: direct counts of referrers from before the edge table", """
+    -- legacy referrals only bumped users.referrals_count and left no edge
+    INSERT INTO referral_stats (user_id, direct_count)
+        SELECT user_id, referrals_count FROM users WHERE referrals_count > 0
+        ON CONFLICT(user_id) DO UPDATE SET direct_count = MAX(direct_count, excluded.direct_count);
+    """),
+    (11, "reconciliation: total_earned_micro counts negative adjustments", """
+    -- folded under the old positive-only rule: refold the ledger from the start
+    DELETE FROM ledger_balances;
+    DELETE FROM recon_state WHERE name = 'ledger_tx_id';
+    """),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-def ensure_user(user_id: int, username: Optional[str]=None, referred_by: Optional[int]=None):
-    conn = get_conn(); c = conn.cursor()
+def _split_sql(script:str):
+    buf = ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            stmt = buf.strip()
+            if stmt and not all(l.strip().startswith("--") or not l.strip() for l in stmt.splitlines()):
+                yield stmt
+            buf = ""
+
+def schema_version(conn=None):
+    conn = conn or get_conn()
+    r = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'").fetchone()
+    if not r: return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate():
+    conn = _open_conn(isolation_level=None)
+    applied = []
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at INTEGER)")
+        for version, desc, step in MIGRATIONS:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if schema_version(conn) >= version:
+                    conn.execute("COMMIT"); continue
+                if callable(step):
+                    step(conn)
+                else:
+                    for stmt in _split_sql(step):
+                        conn.execute(stmt)
+                conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)", (version, desc, int(time.time())))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction: conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+            print(f"Applied migration {version}: {desc}")
+    finally:
+        conn.close()
+    return applied
+
+# Queries that must be served by an index; check_query_plans() reports any that
+# falls back to a full table scan or a temp b-tree sort.
+HOT_QUERIES = [
+    ("get_click", "SELECT * FROM clicks WHERE user_id = ? AND token = ?", (0, "")),
+    ("claim_ad", "SELECT 1 FROM ad_claims WHERE user_id = ? AND token = ?", (0, "")),
+    ("get_user", "SELECT * FROM users WHERE user_id = ?", (0,)),
+    ("pending_withdraws_page", "SELECT id, user_id, amount_micro, requested_at FROM withdraws WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?", (0, 10)),
+    ("approve_withdraws", "SELECT id, user_id, amount_micro FROM withdraws WHERE status = 'pending' AND id > ? AND id <= ? AND amount_micro <= ? ORDER BY id LIMIT ?", (0, 0, 0, 1)),
+    ("top_users", "SELECT user_id, balance_micro FROM users ORDER BY balance_micro DESC, user_id LIMIT ?", (10,)),
+    ("daily_stats", "SELECT day, type, count, amount_micro FROM stats_daily WHERE day >= ? ORDER BY day, type", ("",)),
+    ("export_chunk", "SELECT id, user_id, type, amount_micro, created_at FROM transactions WHERE (created_at, id) > (?, ?) AND created_at < ? ORDER BY created_at, id LIMIT ?", (0, 0, 1, 10)),
+    ("referral_direct", "SELECT r.referrer_id, COUNT(*), COALESCE(SUM(u.total_earned_micro), 0) FROM referrals r LEFT JOIN users u ON u.user_id = r.referee_id "
+                        "WHERE r.referrer_id > ? AND r.referrer_id <= ? GROUP BY r.referrer_id", (0, 1)),
+    ("referral_depth2", "SELECT r1.referrer_id, COUNT(*) FROM referrals r1 JOIN referrals r2 ON r2.referrer_id = r1.referee_id "
+                        "WHERE r1.referrer_id > ? AND r1.referrer_id <= ? GROUP BY r1.referrer_id", (0, 1)),
+]
+
+def check_query_plans(conn=None):
+    conn = conn or get_conn()
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+            detail = r["detail"]
+            if (detail.startswith("SCAN ") and " USING " not in detail) or "TEMP B-TREE" in detail:
+                problems.append(f"{name}: {detail}")
+    return problems
+
+def init_db():
+    # every start: one read of schema_version; the migration transactions and
+    # the query plan check only run when the schema is behind the code
+    conn = _open_conn()
+    try:
+        current = schema_version(conn)
+    finally:
+        conn.close()
+    if current >= SCHEMA_VERSION:
+        return []
+    applied = migrate()
+    for p in check_query_plans():
+        print("WARNING query plan:", p)
+    return applied
+
+# -------------------------
+# Stats
+# -------------------------
+# Running counters (stats_counters) and per-day transaction totals by type
+# (stats_daily, UTC days) are bumped inside the same write op that changes the
+# underlying rows, so admin stats read a few rows instead of counting tables.
+def bump_stat(c, name:str, delta:int=1):
+    c.execute("INSERT INTO stats_counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+              (name, delta))
+
+def bump_daily(c, ts:int, tx_type:str, amount_micro:int):
+    c.execute("INSERT INTO stats_daily (day, type, count, amount_micro) VALUES (date(?, 'unixepoch'), ?, 1, ?) "
+              "ON CONFLICT(day, type) DO UPDATE SET count = count + 1, amount_micro = amount_micro + excluded.amount_micro",
+              (ts, tx_type, amount_micro))
+
+def get_stats():
+    c = get_conn().cursor()
+    c.execute("SELECT name, value FROM stats_counters")
+    return {r["name"]: r["value"] for r in c.fetchall()}
+
+def daily_stats(days:int=7):
+    # -> {day: {type: (count, amount_micro)}} for the last `days` UTC days, oldest first
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    c = get_conn().cursor()
+    c.execute("SELECT day, type, count, amount_micro FROM stats_daily WHERE day >= ? ORDER BY day, type", (since,))
+    out = {}
+    for r in c.fetchall():
+        out.setdefault(r["day"], {})[r["type"]] = (r["count"], r["amount_micro"])
+    return out
+
+def user_exists(user_id:int):
+    c = get_conn().cursor()
     c.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-    if not c.fetchone():
-        c.execute("INSERT INTO users (user_id, username, referred_by) VALUES (?, ?, ?)", (user_id, username, referred_by))
-        conn.commit()
-    conn.close()
+    return c.fetchone() is not None
+
+@write_op
+def _insert_user(c, user_id: int, username: Optional[str]=None, referred_by: Optional[int]=None):
+    # a referral only counts for a brand-new user whose referrer exists
+    if referred_by is not None and (referred_by == user_id or c.execute("SELECT 1 FROM users WHERE user_id = ?", (referred_by,)).fetchone() is None):
+        referred_by = None
+    c.execute("INSERT OR IGNORE INTO users (user_id, username, referred_by) VALUES (?, ?, ?) RETURNING *", (user_id, username, referred_by))
+    row = c.fetchone()
+    if not row: return False
+    bump_stat(c, "users")
+    after_commit(_user_written, dict(row))
+    if referred_by is not None:
+        add_referral(c, user_id, referred_by)
+    return True
+
+def ensure_user(user_id: int, username: Optional[str]=None, referred_by: Optional[int]=None):
+    # read first on the pool; only new users cost a write
+    if not user_exists(user_id):
+        _insert_user(user_id, username, referred_by)
 
 def get_user(user_id:int):
-    conn = get_conn(); c = conn.cursor()
+    c = get_conn().cursor()
     c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    r = c.fetchone(); conn.close(); return r
+    return c.fetchone()
 
-def credit(user_id:int, amount_micro:int, field:str="balance_micro", add_total=True, tx_type:str="credit"):
-    conn = get_conn(); c = conn.cursor()
-    c.execute(f"UPDATE users SET {field} = {field} + ? WHERE user_id = ?", (amount_micro, user_id))
-    if add_total:
-        c.execute("UPDATE users SET total_earned_micro = total_earned_micro + ? WHERE user_id = ?", (amount_micro, user_id))
+@write_op
+def credit(c, user_id:int, amount_micro:int, field:str="balance_micro", add_total=True, tx_type:str="credit"):
+    # sub-balances (ad/offer/referral) break the total down by source; the
+    # amount always lands in balance_micro too, which is what can be withdrawn
+    sets = "balance_micro = balance_micro + :amt" + ("" if field == "balance_micro" else f", {field} = {field} + :amt")
+    c.execute(f"UPDATE users SET {sets}, total_earned_micro = total_earned_micro + :earned WHERE user_id = :uid RETURNING *",
+              {"amt": amount_micro, "earned": amount_micro if add_total else 0, "uid": user_id})
+    row = c.fetchone()
+    if row:
+        after_commit(_user_written, dict(row))
+        if add_total and row["referred_by"] is not None:
+            # what a referee earns counts toward their referrer's stats
+            c.execute("UPDATE referral_stats SET earnings_micro = earnings_micro + ? WHERE user_id = ?", (amount_micro, row["referred_by"]))
     ts = int(datetime.utcnow().timestamp())
     c.execute("INSERT INTO transactions (user_id, type, amount_micro, created_at) VALUES (?, ?, ?, ?)", (user_id, tx_type, amount_micro, ts))
-    conn.commit(); conn.close()
+    bump_daily(c, ts, tx_type, amount_micro)
+    return row
 
-def record_click(user_id:int, token:str):
-    ts = int(datetime.utcnow().timestamp())
-    conn = get_conn(); c = conn.cursor()
-    c.execute("INSERT INTO clicks (user_id, token, ts) VALUES (?, ?, ?)", (user_id, token, ts))
-    conn.commit(); conn.close()
+@write_op
+def record_click(c, user_id:int, token:str, ts:Optional[int]=None):
+    # audit row for the first open of a token; repeated opens are not rewritten
+    ts = ts or int(datetime.utcnow().timestamp())
+    c.execute("INSERT OR IGNORE INTO clicks (user_id, token, ts) VALUES (?, ?, ?)", (user_id, token, ts))
     return ts
 
 def get_click(user_id:int, token:str):
-    conn = get_conn(); c = conn.cursor()
-    c.execute("SELECT * FROM clicks WHERE user_id = ? AND token = ? ORDER BY ts DESC LIMIT 1", (user_id, token))
-    r = c.fetchone(); conn.close(); return r
+    c = get_conn().cursor()
+    c.execute("SELECT * FROM clicks WHERE user_id = ? AND token = ?", (user_id, token))
+    return c.fetchone()
 
-def inc_ads_today(user_id:int):
+@write_op
+def inc_ads_today(c, user_id:int):
     today = date.today().isoformat()
-    conn = get_conn(); c = conn.cursor()
     c.execute("SELECT last_reset_date, ads_today FROM users WHERE user_id = ?", (user_id,))
     row = c.fetchone()
-    if not row: conn.close(); return 0
+    if not row: return 0
     last = row["last_reset_date"]; ads = row["ads_today"] or 0
-    if last != today:
-        c.execute("UPDATE users SET last_reset_date = ?, ads_today = 1 WHERE user_id = ?", (today, user_id))
-        conn.commit(); conn.close(); return 1
-    ads += 1
-    c.execute("UPDATE users SET ads_today = ? WHERE user_id = ?", (ads, user_id))
-    conn.commit(); conn.close(); return ads
+    ads = 1 if last != today else ads + 1
+    c.execute("UPDATE users SET last_reset_date = ?, ads_today = ? WHERE user_id = ? RETURNING *", (today, ads, user_id))
+    after_commit(_user_written, dict(c.fetchone()))
+    return ads
 
 def can_watch_more_ads(user_id:int, max_per_day:int):
     today = date.today().isoformat()
-    conn = get_conn(); c = conn.cursor()
+    c = get_conn().cursor()
     c.execute("SELECT last_reset_date, ads_today FROM users WHERE user_id = ?", (user_id,))
-    row = c.fetchone(); conn.close()
+    row = c.fetchone()
     if not row: return True
     last = row["last_reset_date"]; ads = row["ads_today"] or 0
     if last != today: return True
     return ads < max_per_day
 
 def has_claimed_daily(user_id:int):
-    conn = get_conn(); c = conn.cursor()
+    c = get_conn().cursor()
     c.execute("SELECT last_daily_bonus FROM users WHERE user_id = ?", (user_id,))
-    row = c.fetchone(); conn.close()
+    row = c.fetchone()
     if not row: return False
     return row["last_daily_bonus"] == date.today().isoformat()
 
-def set_daily_bonus_claimed(user_id:int):
+@write_op
+def set_daily_bonus_claimed(c, user_id:int):
     today = date.today().isoformat()
-    conn = get_conn(); c = conn.cursor()
-    c.execute("UPDATE users SET last_daily_bonus = ? WHERE user_id = ?", (today, user_id))
-    conn.commit(); conn.close()
-
-def add_referral_for(referrer_id:int):
-    conn = get_conn(); c = conn.cursor()
-    c.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?", (referrer_id,))
-    conn.commit(); conn.close()
+    c.execute("UPDATE users SET last_daily_bonus = ? WHERE user_id = ? RETURNING *", (today, user_id))
+    row = c.fetchone()
+    if row: after_commit(_user_written, dict(row))
 
-def add_withdraw_request(user_id:int, amount_micro:int):
+@write_op
+def add_withdraw_request(c, user_id:int, amount_micro:int):
     ts = int(datetime.utcnow().timestamp())
-    conn = get_conn(); c = conn.cursor()
     c.execute("INSERT INTO withdraws (user_id, amount_micro, status, requested_at) VALUES (?, ?, 'pending', ?)", (user_id, amount_micro, ts))
     wid = c.lastrowid
-    conn.commit(); conn.close()
+    bump_stat(c, "withdraws_pending"); bump_stat(c, "withdraws_pending_micro", amount_micro)
     return wid
 
-def get_pending_withdraws():
-    conn = get_conn(); c = conn.cursor()
-    c.execute("SELECT * FROM withdraws WHERE status = 'pending'")
-    r = c.fetchall(); conn.close(); return r
-
-def approve_withdraw(wid:int):
-    conn = get_conn(); c = conn.cursor()
+def get_withdraw(wid:int):
+    c = get_conn().cursor()
     c.execute("SELECT * FROM withdraws WHERE id = ?", (wid,))
+    return c.fetchone()
+
+def pending_withdraws_page(after_id:int, limit:int):
+    # keyset page of the pending queue (idx_withdraws_status covers it)
+    c = get_conn().cursor()
+    c.execute("SELECT id, user_id, amount_micro, requested_at FROM withdraws WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+              (after_id, limit))
+    return c.fetchall()
+
+def pending_withdraws_summary(max_id:Optional[int]=None, max_amount_micro:Optional[int]=None):
+    # -> (count, total micro, highest id) of pending requests, optionally capped by id / amount
+    c = get_conn().cursor()
+    c.execute("SELECT COUNT(*), COALESCE(SUM(amount_micro), 0), MAX(id) FROM withdraws WHERE status = 'pending' AND id <= ? AND amount_micro <= ?",
+              (max_id if max_id is not None else 2**62, max_amount_micro if max_amount_micro is not None else 2**62))
+    n, total, top = c.fetchone()
+    return n, total, top or 0
+
+def _settle_withdraws(c, rows):
+    # rows: pending withdraws (id, user_id, amount_micro) in id order. A row is
+    # settled only if what is left of the user's balance covers it (a double
+    # tap files two requests for the full balance); the rest stay pending.
+    # Deducts balance_micro once per user, marks the settled rows approved and
+    # moves the counters -> (settled rows, uncovered rows)
+    left = {}; settled = []; uncovered = []
+    for r in rows:
+        uid = r["user_id"]
+        if uid not in left:
+            b = c.execute("SELECT balance_micro FROM users WHERE user_id = ?", (uid,)).fetchone()
+            left[uid] = b[0] if b else 0
+        if r["amount_micro"] > left[uid]:
+            uncovered.append(r); continue
+        left[uid] -= r["amount_micro"]; settled.append(r)
+    rows = settled
+    if not rows: return settled, uncovered
+    per_user = Counter()
+    for r in rows: per_user[r["user_id"]] += r["amount_micro"]
+    for user_id, amt in per_user.items():
+        c.execute("UPDATE users SET balance_micro = balance_micro - ? WHERE user_id = ? RETURNING *", (amt, user_id))
+        u = c.fetchone()
+        if u: after_commit(_user_written, dict(u))
+    c.executemany("UPDATE withdraws SET status = 'approved' WHERE id = ?", [(r["id"],) for r in rows])
+    # one negative ledger row per payout, so the ledger sums to balance_micro
+    ts = int(datetime.utcnow().timestamp())
+    c.executemany("INSERT INTO transactions (user_id, type, amount_micro, created_at) VALUES (?, 'withdraw', ?, ?)",
+                  [(r["user_id"], -r["amount_micro"], ts) for r in rows])
+    total = sum(per_user.values())
+    c.execute("INSERT INTO stats_daily (day, type, count, amount_micro) VALUES (date(?, 'unixepoch'), 'withdraw', ?, ?) "
+              "ON CONFLICT(day, type) DO UPDATE SET count = count + excluded.count, amount_micro = amount_micro + excluded.amount_micro",
+              (ts, len(rows), -total))
+    bump_stat(c, "withdraws_pending", -len(rows)); bump_stat(c, "withdraws_pending_micro", -total)
+    bump_stat(c, "withdraws_approved", len(rows)); bump_stat(c, "withdraws_approved_micro", total)
+    return settled, uncovered
+
+@write_op
+def approve_withdraw(c, wid:int):
+    # -> the withdraw (dict) with "approved" False when the balance no longer
+    # covers it, or None if it isn't pending
+    c.execute("SELECT id, user_id, amount_micro, status FROM withdraws WHERE id = ?", (wid,))
+    r = c.fetchone()
+    if not r or r["status"] != "pending": return None
+    settled, _ = _settle_withdraws(c, [r])
+    return dict(r, approved=bool(settled))
+
+@write_op
+def approve_withdraws(c, after_id:int, max_id:int, max_amount_micro:Optional[int]=None, limit:int=500):
+    # bulk review: approves pending ids in (after_id, max_id], optionally only
+    # amounts <= max_amount_micro, in one transaction
+    # -> (approved rows, rows left pending because the balance doesn't cover them, last id scanned or None when done)
+    c.execute("SELECT id, user_id, amount_micro FROM withdraws WHERE status = 'pending' AND id > ? AND id <= ? AND amount_micro <= ? ORDER BY id LIMIT ?",
+              (after_id, max_id, max_amount_micro if max_amount_micro is not None else 2**62, limit))
+    rows = c.fetchall()
+    settled, uncovered = _settle_withdraws(c, rows)
+    return [dict(r) for r in settled], [dict(r) for r in uncovered], (rows[-1]["id"] if len(rows) == limit else None)
+
+def offer_user_share(amount_micro:int) -> int:
+    # credit 80% to user offer_balance, owner 20% kept (owner accounting optional)
+    return int(round(amount_micro * 0.80))
+
+@write_op
+def apply_postbacks(c, items):
+    # items: [(txid, user_id, amount_micro)]. The whole batch is one transaction;
+    # the unique txid makes provider retries no-ops.
+    # -> [("credited", share) | ("duplicate", 0)] in item order
+    now = int(time.time())
+    results = []
+    for txid, user_id, amount_micro in items:
+        share = offer_user_share(amount_micro)
+        c.execute("INSERT OR IGNORE INTO postbacks (txid, user_id, amount_micro, user_share_micro, created_at) VALUES (?, ?, ?, ?, ?)",
+                  (txid, user_id, amount_micro, share, now))
+        if c.rowcount == 0:
+            results.append(("duplicate", 0)); continue
+        _insert_user._tx(c, user_id)
+        credit._tx(c, user_id, share, "offer_balance_micro", True, "offer")
+        results.append(("credited", share))
+    return results
+
+# Fused claim paths: check + credit + counters in one writer transaction, so two
+# fast taps can't both pass the checks (the writer serializes them) and every
+# token is claimable once (ad_claims primary key).
+@write_op
+def claim_ad(c, user_id:int, token:str, click_ts:int, wait_seconds:int, max_per_day:int, reward_micro:int):
+    # click_ts comes from click_store (the token was verified there)
+    # -> ("ok", new_balance) | ("claimed", None) | ("wait", elapsed) | ("limit", None)
+    c.execute("SELECT 1 FROM ad_claims WHERE user_id = ? AND token = ?", (user_id, token))
+    if c.fetchone(): return ("claimed", None)
+    now = int(time.time())
+    elapsed = now - click_ts
+    if elapsed < wait_seconds: return ("wait", elapsed)
+    today = date.today().isoformat()
+    c.execute("SELECT last_reset_date, ads_today FROM users WHERE user_id = ?", (user_id,))
+    row = c.fetchone()
+    ads = (row["ads_today"] or 0) if row and row["last_reset_date"] == today else 0
+    if ads >= max_per_day: return ("limit", None)
+    c.execute("INSERT INTO ad_claims (user_id, token, claimed_at) VALUES (?, ?, ?)", (user_id, token, now))
+    credit._tx(c, user_id, reward_micro, "ad_balance_micro", True, "ad")
+    c.execute("UPDATE users SET last_reset_date = ?, ads_today = ? WHERE user_id = ? RETURNING *", (today, ads + 1, user_id))
+    r = c.fetchone()
+    if not r: return ("ok", 0)
+    after_commit(_user_written, dict(r))
+    return ("ok", r["balance_micro"])
+
+@write_op
+def claim_daily_bonus(c, user_id:int, amount_micro:int):
+    # -> new balance, or None if already claimed today
+    today = date.today().isoformat()
+    c.execute("UPDATE users SET last_daily_bonus = ? WHERE user_id = ? AND (last_daily_bonus IS NULL OR last_daily_bonus != ?)", (today, user_id, today))
+    if c.rowcount == 0: return None
+    row = credit._tx(c, user_id, amount_micro, "balance_micro", True, "bonus")
+    return row["balance_micro"]
+
+@write_op
+def reject_withdraw(c, wid:int):
+    # only a pending request can be rejected (keeps the counters exact)
+    # -> the rejected withdraw (dict), or None
+    c.execute("UPDATE withdraws SET status = 'rejected' WHERE id = ? AND status = 'pending' RETURNING id, user_id, amount_micro", (wid,))
     r = c.fetchone()
-    if not r: conn.close(); return False
-    if r["status"] != "pending": conn.close(); return False
-    user_id = r["user_id"]; amt = r["amount_micro"]
-    # deduct user_balance (we deduct from balance_micro)
-    c.execute("UPDATE users SET balance_micro = balance_micro - ? WHERE user_id = ?", (amt, user_id))
-    c.execute("UPDATE withdraws SET status = 'approved' WHERE id = ?", (wid,))
-    conn.commit(); conn.close(); return True
-
-def reject_withdraw(wid:int):
-    conn = get_conn(); c = conn.cursor()
-    c.execute("UPDATE withdraws SET status = 'rejected' WHERE id = ?", (wid,))
-    conn.commit(); conn.close(); return True
+    if not r: return None
+    bump_stat(c, "withdraws_pending", -1); bump_stat(c, "withdraws_pending_micro", -r["amount_micro"])
+    bump_stat(c, "withdraws_rejected")
+    return dict(r)
 
 def total_users():
-    conn = get_conn(); c = conn.cursor()
-    c.execute("SELECT COUNT(*) as cnt FROM users"); r = c.fetchone(); conn.close(); return r["cnt"]
+    c = get_conn().cursor()
+    c.execute("SELECT value FROM stats_counters WHERE name = 'users'")
+    r = c.fetchone(); return r["value"] if r else 0
 
 def top_users(limit=10):
-    conn = get_conn(); c = conn.cursor()
-    c.execute("SELECT user_id, balance_micro FROM users ORDER BY balance_micro DESC LIMIT ?", (limit,))
-    rows = c.fetchall(); conn.close(); return rows
+    c = get_conn().cursor()
+    c.execute("SELECT user_id, balance_micro FROM users ORDER BY balance_micro DESC, user_id LIMIT ?", (limit,))
+    return c.fetchall()
+
+# awaitable versions (run on the DB pool, never on the event loop)
+ainit_db = _awaitable(init_db)
+auser_exists = _awaitable(user_exists)
+a_insert_user = _awaitable(_insert_user)
+_aget_user_db = _awaitable(get_user)
+acredit = _awaitable(credit)
+arecord_click = _awaitable(record_click)
+aget_click = _awaitable(get_click)
+ainc_ads_today = _awaitable(inc_ads_today)
+acan_watch_more_ads = _awaitable(can_watch_more_ads)
+ahas_claimed_daily = _awaitable(has_claimed_daily)
+aset_daily_bonus_claimed = _awaitable(set_daily_bonus_claimed)
+aadd_withdraw_request = _awaitable(add_withdraw_request)
+aget_withdraw = _awaitable(get_withdraw)
+apending_withdraws_page = _awaitable(pending_withdraws_page)
+apending_withdraws_summary = _awaitable(pending_withdraws_summary)
+aapprove_withdraw = _awaitable(approve_withdraw)
+aapprove_withdraws = _awaitable(approve_withdraws)
+aapply_postbacks = _awaitable(apply_postbacks)
+aclaim_ad = _awaitable(claim_ad)
+aclaim_daily_bonus = _awaitable(claim_daily_bonus)
+areject_withdraw = _awaitable(reject_withdraw)
+atotal_users = _awaitable(total_users)
+aget_stats = _awaitable(get_stats)
+adaily_stats = _awaitable(daily_stats)
+atop_users = _awaitable(top_users)
+
+# -------------------------
+# User cache
+# -------------------------
+# Bounded LRU + TTL of user rows (plain dicts). Filled on first read and
+# written through by every user write (after_commit -> _user_written), so menu
+# screens (/start, balance, referrals, withdraw) usually need no DB read. Each
+# entry remembers the generation of the write that produced it: a read that
+# started before a newer write won't overwrite the fresher row.
+# Off by default with several workers: a row cached here can't see another
+# worker's write.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "0" if MULTI_WORKER else "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+class UserCache:
+    def __init__(self, maxsize:int=USER_CACHE_SIZE, ttl:float=USER_CACHE_TTL):
+        self.maxsize = maxsize; self.ttl = ttl
+        self._d = OrderedDict()     # user_id -> (expires_at, row, gen)
+        self._lock = threading.Lock()
+        self._gen = 0
+        self.hits = 0; self.misses = 0; self.evictions = 0; self.expirations = 0
+
+    def generation(self):
+        return self._gen
+
+    def get(self, user_id:int):
+        with self._lock:
+            e = self._d.get(user_id)
+            if e is None:
+                self.misses += 1; return None
+            if e[0] < time.monotonic():
+                del self._d[user_id]
+                self.expirations += 1; self.misses += 1; return None
+            self._d.move_to_end(user_id)
+            self.hits += 1
+            return e[1]
+
+    def _store(self, row, gen):
+        self._d[row["user_id"]] = (time.monotonic() + self.ttl, row, gen)
+        self._d.move_to_end(row["user_id"])
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False); self.evictions += 1
+
+    def put(self, row:dict):
+        # authoritative row from a committed write
+        if self.maxsize <= 0 or self.ttl <= 0: return
+        with self._lock:
+            self._gen += 1
+            self._store(row, self._gen)
+
+    def fill(self, row:dict, gen:int):
+        # row read from the DB when generation() was gen
+        if self.maxsize <= 0 or self.ttl <= 0: return
+        with self._lock:
+            e = self._d.get(row["user_id"])
+            if e is not None and e[2] > gen: return
+            self._store(row, gen)
+
+    def invalidate(self, user_id:Optional[int]=None):
+        with self._lock:
+            if user_id is None: self._d.clear()
+            else: self._d.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._d), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+user_cache = UserCache()
+
+def _user_written(row:dict):
+    # after_commit hook for every write that changes a users row
+    user_cache.put(row)
+    leaderboard.update(row["user_id"], row["balance_micro"])
+
+async def aget_user(user_id:int):
+    row = user_cache.get(user_id)
+    if row is not None: return row
+    gen = user_cache.generation()
+    r = await _aget_user_db(user_id)
+    if r is None: return None
+    row = dict(r)
+    user_cache.fill(row, gen)
+    return row
+
+async def aensure_user(user_id: int, username: Optional[str]=None, referred_by: Optional[int]=None):
+    if await aget_user(user_id) is None:
+        await a_insert_user(user_id, username, referred_by)
+
+# -------------------------
+# Leaderboard cache
+# -------------------------
+# Top-N kept in process: seeded once from the DB, then updated by the
+# after_commit hooks of every balance write (credit, approve_withdraw, new
+# users). We track LEADERBOARD_TRACK users (more than we show) plus "floor",
+# an upper bound on the balance of every untracked user. The visible top-N is
+# exact while each of its entries is above floor; when a decrease breaks that,
+# the next read reseeds (one indexed query). The rendered text is rebuilt only
+# when the top-N actually changes.
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))
+LEADERBOARD_TRACK = int(os.getenv("LEADERBOARD_TRACK", "50"))
+# with several workers this process only sees its own writes: reseed at least
+# every LEADERBOARD_TTL seconds (0 = never needed)
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", "30" if MULTI_WORKER else "0"))
+
+class Leaderboard:
+    def __init__(self, size:int=LEADERBOARD_SIZE, track:int=LEADERBOARD_TRACK, ttl:float=LEADERBOARD_TTL):
+        self.size = size
+        self.track = max(track, size)
+        self.ttl = ttl
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._bal = {}
+        self._floor = None
+        self._seeded = False
+        self._top = ()
+        self._text = None
+        self.version = 0; self.reseeds = 0
+
+    def load(self, rows):
+        # rows: top (track + 1) users ordered like top_users()
+        with self._lock:
+            self._bal = {r["user_id"]: r["balance_micro"] for r in rows[:self.track]}
+            self._floor = rows[self.track]["balance_micro"] if len(rows) > self.track else None
+            self._seeded = True; self.reseeds += 1; self._loaded_at = time.monotonic()
+            self._refresh()
+
+    def update(self, user_id:int, balance:int):
+        with self._lock:
+            if not self._seeded: return
+            if user_id in self._bal:
+                if self._floor is not None and balance < self._floor:
+                    del self._bal[user_id]      # now below users we don't track
+                else:
+                    self._bal[user_id] = balance
+            elif self._floor is None or balance > self._floor:
+                self._bal[user_id] = balance
+                if len(self._bal) > self.track:
+                    low = min(self._bal, key=lambda u: (self._bal[u], -u))
+                    lb = self._bal.pop(low)
+                    self._floor = lb if self._floor is None else max(self._floor, lb)
+            else:
+                return
+            self._refresh()
+
+    def _refresh(self):
+        top = tuple(sorted(self._bal.items(), key=lambda kv: (-kv[1], kv[0]))[:self.size])
+        if top != self._top:
+            self._top = top; self._text = None; self.version += 1
+
+    def ready(self):
+        with self._lock:
+            if not self._seeded: return False
+            if self.ttl and time.monotonic() - self._loaded_at > self.ttl: return False
+            if self._floor is None: return True
+            return len(self._top) >= self.size and self._top[-1][1] > self._floor
+
+    def invalidate(self):
+        with self._lock:
+            self._seeded = False
+
+    def top(self):
+        with self._lock:
+            return self._top
+
+    def render(self):
+        with self._lock:
+            if self._text is None:
+                text = "🏆 Leaderboard\n\n"
+                for i, (user_id, bal) in enumerate(self._top, start=1):
+                    text += f"{i}. {user_id} — {micro_to_usd(bal)}\n"
+                self._text = text
+            return self._text
+
+leaderboard = Leaderboard()
+
+def _seed_leaderboard(c):
+    # runs on the writer so no balance write can interleave with the seed
+    c.execute("SELECT user_id, balance_micro FROM users ORDER BY balance_micro DESC, user_id LIMIT ?", (leaderboard.track + 1,))
+    leaderboard.load(c.fetchall())
+
+async def leaderboard_text():
+    if not leaderboard.ready():
+        await db_writer.run(_seed_leaderboard)
+    return leaderboard.render()
+
+async def check_leaderboard():
+    # -> (ok, cached, db); reseeds on mismatch
+    cached = [tuple(e) for e in leaderboard.top()]
+    db = [(r["user_id"], r["balance_micro"]) for r in await atop_users(leaderboard.size)]
+    ok = cached == db
+    if not ok:
+        await db_writer.run(_seed_leaderboard)
+    return ok, cached, db
+
+# -------------------------
+# Click token store
+# -------------------------
+# A token matters only between "Open Ad" (/v) and "I watched". The store keeps
+# (user_id, token) -> first-open ts in memory for CLICK_TOKEN_TTL seconds and
+# serves the claim lookup without touching disk. /v only queues the audit row
+# (first open per token) on the writer without waiting for it; a memory miss
+# (restart, other process) falls back to the clicks table. Tokens older than
+# the TTL can't be claimed.
+CLICK_TOKEN_TTL = int(os.getenv("CLICK_TOKEN_TTL", "1800"))
+CLICK_STORE_MAX = int(os.getenv("CLICK_STORE_MAX", "200000"))
+
+class ClickTokenStore:
+    def __init__(self, ttl:int=CLICK_TOKEN_TTL, maxsize:int=CLICK_STORE_MAX):
+        self.ttl = ttl; self.maxsize = maxsize
+        self._d = OrderedDict()     # (user_id, token) -> ts, oldest first
+        self.hits = 0; self.misses = 0; self.db_hits = 0
+
+    def _expire(self, now:int):
+        while self._d:
+            key, ts = next(iter(self._d.items()))
+            if ts > now - self.ttl and len(self._d) <= self.maxsize: break
+            self._d.popitem(last=False)
+
+    def record(self, user_id:int, token:str) -> int:
+        now = int(time.time())
+        self._expire(now)
+        key = (user_id, token)
+        ts = self._d.get(key)
+        if ts is None:
+            ts = self._d[key] = now
+            db_writer.submit(record_click._tx, user_id, token, ts)     # fire and forget
+        return ts
+
+    async def get(self, user_id:int, token:str) -> Optional[int]:
+        now = int(time.time())
+        ts = self._d.get((user_id, token))
+        if ts is not None and ts > now - self.ttl:
+            self.hits += 1; return ts
+        self.misses += 1
+        row = await aget_click(user_id, token)
+        if row is None or row["ts"] <= now - self.ttl: return None
+        self.db_hits += 1
+        return row["ts"]
+
+    def discard(self, user_id:int, token:str):
+        self._d.pop((user_id, token), None)
+
+    def stats(self):
+        return {"size": len(self._d), "hits": self.hits, "misses": self.misses, "db_hits": self.db_hits}
+
+click_store = ClickTokenStore()
+
+# Retention: clicks older than CLICK_RETENTION_DAYS are folded into click_daily
+# (per user per day) and deleted, CLICK_ROLLUP_CHUNK rows per writer op so live
+# writes interleave with the job. Old ad_claims rows go too: their tokens are
+# long past the TTL.
+CLICK_RETENTION_DAYS = int(os.getenv("CLICK_RETENTION_DAYS", "7"))
+CLICK_ROLLUP_CHUNK = int(os.getenv("CLICK_ROLLUP_CHUNK", "5000"))
+CLICK_RETENTION_INTERVAL = int(os.getenv("CLICK_RETENTION_INTERVAL", "3600"))
+
+@write_op
+def roll_up_clicks(c, cutoff_ts:int, limit:int):
+    c.execute("SELECT MAX(id) AS last, COUNT(*) AS n FROM (SELECT id FROM clicks WHERE ts < ? ORDER BY id LIMIT ?)", (cutoff_ts, limit))
+    r = c.fetchone()
+    if not r["n"]: return 0
+    c.execute("""INSERT INTO click_daily (user_id, day, clicks)
+                 SELECT user_id, date(ts, 'unixepoch'), COUNT(*) FROM clicks WHERE id <= ? AND ts < ?
+                 GROUP BY user_id, date(ts, 'unixepoch')
+                 ON CONFLICT(user_id, day) DO UPDATE SET clicks = clicks + excluded.clicks""", (r["last"], cutoff_ts))
+    c.execute("DELETE FROM clicks WHERE id <= ? AND ts < ?", (r["last"], cutoff_ts))
+    return c.rowcount
+
+@write_op
+def prune_ad_claims(c, cutoff_ts:int, limit:int):
+    c.execute("DELETE FROM ad_claims WHERE rowid IN (SELECT rowid FROM ad_claims WHERE claimed_at < ? LIMIT ?)", (cutoff_ts, limit))
+    return c.rowcount
+
+aroll_up_clicks = _awaitable(roll_up_clicks)
+aprune_ad_claims = _awaitable(prune_ad_claims)
+
+async def run_click_retention(days:int=CLICK_RETENTION_DAYS, chunk:int=CLICK_ROLLUP_CHUNK):
+    cutoff = int(time.time()) - days * 86400
+    rolled = pruned = 0
+    while True:
+        n = await aroll_up_clicks(cutoff, chunk)
+        rolled += n
+        if n < chunk: break
+    while True:
+        n = await aprune_ad_claims(cutoff, chunk)
+        pruned += n
+        if n < chunk: break
+    return rolled, pruned
+
+async def click_retention_loop():
+    while True:
+        try:
+            rolled, pruned = await run_click_retention()
+            if rolled or pruned:
+                print(f"Click retention: rolled up {rolled} clicks, pruned {pruned} claims")
+        except Exception as e:
+            print("Click retention failed:", e)
+        await asyncio.sleep(CLICK_RETENTION_INTERVAL)
+
+# -------------------------
+# Rate limiting + abuse scoring
+# -------------------------
+# Checked before any DB work in /v and on_button. Each limiter is a two-window
+# sliding counter per key (user id or client IP): the previous fixed window's
+# count weighted by how much of it still overlaps the sliding window, plus the
+# current one. Three numbers per key; keys idle for two windows are evicted
+# every window, so memory follows the active set. Limits are "N/SECONDS"
+# (0 disables).
+def _rate(name:str, default:str):
+    n, _, secs = os.getenv(name, default).partition("/")
+    return int(n), float(secs or 60)
+
+RL_V_PER_USER = _rate("RL_V_PER_USER", "20/60")
+RL_V_PER_IP = _rate("RL_V_PER_IP", "120/60")
+RL_CALLBACK_PER_USER = _rate("RL_CALLBACK_PER_USER", "30/30")
+RL_MAX_KEYS = int(os.getenv("RL_MAX_KEYS", "200000"))
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))   # proxies in front of us that append X-Forwarded-For
+
+class SlidingWindowLimiter:
+    def __init__(self, limit:int, window:float, max_keys:int=RL_MAX_KEYS):
+        self.limit = limit; self.window = window; self.max_keys = max_keys
+        self._d = {}    # key -> [window index, count in it, count in the previous one]
+        self._next_evict = 0.0
+        self.allowed = 0; self.rejected = 0
+
+    def hit(self, key, now:Optional[float]=None) -> bool:
+        if self.limit <= 0: return True
+        now = time.monotonic() if now is None else now
+        if now >= self._next_evict or len(self._d) > self.max_keys:
+            self.evict(now)
+        pos = now / self.window
+        w = int(pos)
+        e = self._d.get(key)
+        if e is None:
+            e = self._d[key] = [w, 0, 0]
+        elif e[0] != w:
+            e[2] = e[1] if e[0] == w - 1 else 0; e[1] = 0; e[0] = w
+        if e[2] * (1 - (pos - w)) + e[1] >= self.limit:
+            self.rejected += 1; return False
+        e[1] += 1; self.allowed += 1
+        return True
+
+    def evict(self, now:float):
+        w = int(now / self.window)
+        self._d = {k: e for k, e in self._d.items() if e[0] >= w - 1}
+        if len(self._d) > self.max_keys:
+            # still too many live keys: drop the quietest ones
+            keep = sorted(self._d.items(), key=lambda kv: kv[1][1] + kv[1][2], reverse=True)[:self.max_keys // 2]
+            self._d = dict(keep)
+        self._next_evict = now + self.window
+
+    def stats(self):
+        return {"keys": len(self._d), "allowed": self.allowed, "rejected": self.rejected}
+
+v_user_limiter = SlidingWindowLimiter(*RL_V_PER_USER)
+v_ip_limiter = SlidingWindowLimiter(*RL_V_PER_IP)
+callback_limiter = SlidingWindowLimiter(*RL_CALLBACK_PER_USER)
+
+def client_ip(request: Request) -> str:
+    # the entry our own proxy appended to X-Forwarded-For; earlier ones are client-supplied
+    if TRUSTED_PROXY_HOPS > 0:
+        fwd = [p.strip() for p in request.headers.get("x-forwarded-for", "").split(",") if p.strip()]
+        if len(fwd) >= TRUSTED_PROXY_HOPS:
+            return fwd[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+# Velocity: a per-user score that decays with VELOCITY_HALF_LIFE and grows with
+# every click, claim and suspicious event (confirming before the wait, unknown
+# or replayed tokens, being rate limited). Crossing VELOCITY_FLAG_SCORE flags
+# the user to the admin once per VELOCITY_FLAG_COOLDOWN; no DB access at all.
+VELOCITY_HALF_LIFE = float(os.getenv("VELOCITY_HALF_LIFE", "600"))
+VELOCITY_FLAG_SCORE = float(os.getenv("VELOCITY_FLAG_SCORE", "40"))
+VELOCITY_FLAG_COOLDOWN = float(os.getenv("VELOCITY_FLAG_COOLDOWN", "3600"))
+VELOCITY_POINTS = {"click": 1, "claim": 1, "early_confirm": 4, "bad_token": 4, "replay": 4, "rate_limited": 2}
+
+class VelocityTracker:
+    def __init__(self, half_life:float=VELOCITY_HALF_LIFE, threshold:float=VELOCITY_FLAG_SCORE,
+                 cooldown:float=VELOCITY_FLAG_COOLDOWN, max_users:int=RL_MAX_KEYS):
+        self.decay = math.log(2) / max(half_life, 1e-6)
+        self.threshold = threshold; self.cooldown = cooldown; self.max_users = max_users
+        self._d = {}                    # user_id -> [score, at, Counter of events]
+        self.flagged = OrderedDict()    # user_id -> (monotonic time, score, events), newest last
+        self._next_evict = 0.0
+
+    def _score(self, e, now:float) -> float:
+        return e[0] * math.exp(-self.decay * (now - e[1]))
+
+    def add(self, user_id:int, event:str, now:Optional[float]=None):
+        # -> (score, events) the first time the user crosses the threshold within the cooldown, else None
+        if not user_id or user_id == ADMIN_ID: return None
+        now = time.monotonic() if now is None else now
+        if now >= self._next_evict or len(self._d) > self.max_users:
+            self.evict(now)
+        e = self._d.get(user_id)
+        if e is None:
+            e = self._d[user_id] = [0.0, now, Counter()]
+        e[0] = self._score(e, now) + VELOCITY_POINTS.get(event, 1); e[1] = now; e[2][event] += 1
+        if e[0] < self.threshold: return None
+        last = self.flagged.get(user_id)
+        if last is not None and now - last[0] < self.cooldown: return None
+        self.flagged[user_id] = (now, e[0], dict(e[2])); self.flagged.move_to_end(user_id)
+        while len(self.flagged) > 100: self.flagged.popitem(last=False)
+        return e[0], dict(e[2])
+
+    def evict(self, now:float):
+        # scores that decayed below one point carry no signal
+        self._d = {u: e for u, e in self._d.items() if self._score(e, now) >= 1.0}
+        if len(self._d) > self.max_users:
+            self._d = dict(sorted(self._d.items(), key=lambda kv: kv[1][0], reverse=True)[:self.max_users // 2])
+        self._next_evict = now + 60
+
+    def stats(self):
+        return {"tracked": len(self._d), "flagged": list(self.flagged)[-10:]}
+
+velocity = VelocityTracker()
+
+def note_velocity(user_id:int, event:str):
+    flag = velocity.add(user_id, event)
+    if flag is not None and application is not None:
+        score, events = flag
+        text = (f"🚩 Suspicious activity: user {user_id} (score {score:.0f}, half-life {VELOCITY_HALF_LIFE / 60:.0f}min)\n"
+                + ", ".join(f"{k} {v}" for k, v in sorted(events.items(), key=lambda kv: -kv[1])))
+        start_background(tg_sender.send(application.bot, ADMIN_ID, text), "velocity-flag")
+
+def too_many(retry_after:float) -> Response:
+    return Response(b"Too Many Requests", status_code=429, media_type="text/plain",
+                    headers={"Retry-After": str(max(1, int(retry_after)))})
+
+# -------------------------
+# Reconciliation
+# -------------------------
+# Every balance change has a ledger row in `transactions` (credits positive,
+# approved withdraws negative). reconcile() folds ledger rows past the
+# recon_state checkpoint into per-user sums (ledger_balances), RECON_FOLD_CHUNK
+# ids per writer transaction, so only new rows are ever scanned; then it
+# compares users against those sums RECON_USER_CHUNK users at a time and
+# reports (or, with repair, resets the users columns to) any drift. The ledger
+# is the source of truth. Each compare step first folds whatever was written
+# since the previous step, inside the same transaction, so both sides are
+# compared at the same point in time.
+RECON_FOLD_CHUNK = int(os.getenv("RECON_FOLD_CHUNK", "20000"))
+RECON_USER_CHUNK = int(os.getenv("RECON_USER_CHUNK", "5000"))
+RECON_SAMPLES = 10
+
+# users column -> expected value from one ledger row (summed per user).
+# total_earned_micro follows credit(): every non-withdraw amount, negative
+# adjustments included.
+RECON_COLUMNS = {
+    "balance_micro": "amount_micro",
+    "ad_balance_micro": "CASE WHEN type = 'ad' THEN amount_micro ELSE 0 END",
+    "offer_balance_micro": "CASE WHEN type = 'offer' THEN amount_micro ELSE 0 END",
+    "referral_balance_micro": "CASE WHEN type = 'referral' THEN amount_micro ELSE 0 END",
+    "total_earned_micro": "CASE WHEN type != 'withdraw' THEN amount_micro ELSE 0 END",
+}
+
+def _recon_get(c, name:str, default:int=0) -> int:
+    r = c.execute("SELECT value FROM recon_state WHERE name = ?", (name,)).fetchone()
+    return r[0] if r and r[0] is not None else default
+
+def _recon_set(c, name:str, value:int):
+    c.execute("INSERT OR REPLACE INTO recon_state (name, value) VALUES (?, ?)", (name, value))
+
+@write_op
+def fold_ledger(c, limit:int):
+    # folds up to `limit` ledger ids past the checkpoint -> (ids folded, caught up)
+    cp = _recon_get(c, "ledger_tx_id")
+    top = c.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+    hi = min(top, cp + limit)
+    if hi <= cp: return 0, True
+    cols = ", ".join(RECON_COLUMNS)
+    sums = ", ".join(f"SUM({expr})" for expr in RECON_COLUMNS.values())
+    upd = ", ".join(f"{col} = {col} + excluded.{col}" for col in RECON_COLUMNS)
+    c.execute(f"INSERT INTO ledger_balances (user_id, {cols}) SELECT user_id, {sums} FROM transactions "
+              f"WHERE id > ? AND id <= ? AND user_id IS NOT NULL GROUP BY user_id "
+              f"ON CONFLICT(user_id) DO UPDATE SET {upd}", (cp, hi))
+    _recon_set(c, "ledger_tx_id", hi)
+    return hi - cp, hi >= top
+
+@write_op
+def reconcile_users(c, after_user_id:int, limit:int, repair:bool=False):
+    # compares users in the next keyset window -> (users checked, drift rows, last user_id or None when done)
+    while not fold_ledger._tx(c, RECON_FOLD_CHUNK)[1]:
+        pass
+    ids = [r[0] for r in c.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, limit))]
+    if not ids: return 0, [], None
+    mismatch = " OR ".join(f"u.{col} IS NOT IFNULL(l.{col}, 0)" for col in RECON_COLUMNS)
+    sel = ", ".join(f"u.{col}, IFNULL(l.{col}, 0) AS l_{col}" for col in RECON_COLUMNS)
+    rows = c.execute(f"SELECT u.user_id, {sel} FROM users u LEFT JOIN ledger_balances l ON l.user_id = u.user_id "
+                     f"WHERE u.user_id > ? AND u.user_id <= ? AND ({mismatch})", (after_user_id, ids[-1])).fetchall()
+    drift = []
+    for r in rows:
+        for col in RECON_COLUMNS:
+            if r[col] != r["l_" + col]:
+                drift.append((r["user_id"], col, r[col], r["l_" + col]))
+        if repair:
+            sets = ", ".join(f"{col} = ?" for col in RECON_COLUMNS)
+            u = c.execute(f"UPDATE users SET {sets} WHERE user_id = ? RETURNING *",
+                          [r["l_" + col] for col in RECON_COLUMNS] + [r["user_id"]]).fetchone()
+            if u: after_commit(_user_written, dict(u))
+    return len(ids), drift, (ids[-1] if len(ids) == limit else None)
+
+def ledger_orphans():
+    # ledger rows for user_ids that have no users row
+    c = get_conn().cursor()
+    c.execute("SELECT COUNT(*), COALESCE(SUM(balance_micro), 0) FROM ledger_balances l WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = l.user_id)")
+    return tuple(c.fetchone())
+
+afold_ledger = _awaitable(fold_ledger)
+areconcile_users = _awaitable(reconcile_users)
+aledger_orphans = _awaitable(ledger_orphans)
+
+async def reconcile(repair:bool=False):
+    t0 = time.perf_counter()
+    folded = 0
+    while True:
+        n, done = await afold_ledger(RECON_FOLD_CHUNK)
+        folded += n
+        if done: break
+    checked = 0; after = 0
+    drifted_users = set(); per_column = Counter(); samples = []
+    while after is not None:
+        n, drift, after = await areconcile_users(after, RECON_USER_CHUNK, repair)
+        checked += n
+        for user_id, col, stored, expected in drift:
+            drifted_users.add(user_id); per_column[col] += expected - stored
+            if len(samples) < RECON_SAMPLES: samples.append((user_id, col, stored, expected))
+    orphans, orphan_micro = await aledger_orphans()
+    return {"folded": folded, "checked": checked, "drifted": len(drifted_users), "per_column": dict(per_column),
+            "samples": samples, "repaired": len(drifted_users) if repair else 0,
+            "orphans": orphans, "orphan_micro": orphan_micro, "seconds": round(time.perf_counter() - t0, 3)}
+
+# -------------------------
+# Referrals
+# -------------------------
+# `referrals` holds one edge per referee, written together with the new user
+# row, so a referral counts once and only for a user who is new. In the same
+# transaction the referrer's direct_count, the referrer's own referrer's
+# depth2_count and users.referrals_count are bumped and the bonus is credited;
+# credit() adds every earning of a referred user to their referrer's
+# earnings_micro. The referrals screen is then one primary-key read.
+# Referrals counted before the edge table have no edge, only the legacy
+# users.referrals_count (bumped with every edge too), so direct_count is
+# MAX(referrals_count, edges); depth2 and earnings only know the edges.
+# rebuild_referrals() recomputes referral_stats that way from users, edges and
+# the users' total_earned_micro, REFERRAL_REBUILD_CHUNK users per writer transaction.
+REFERRAL_REBUILD_CHUNK = int(os.getenv("REFERRAL_REBUILD_CHUNK", "5000"))
+
+def add_referral(c, referee_id:int, referrer_id:int):
+    # inside the write op that inserted the referee
+    c.execute("INSERT OR IGNORE INTO referrals (referee_id, referrer_id, created_at) VALUES (?, ?, ?)",
+              (referee_id, referrer_id, int(time.time())))
+    if c.rowcount == 0: return False
+    c.execute("INSERT INTO referral_stats (user_id, direct_count) VALUES (?, 1) "
+              "ON CONFLICT(user_id) DO UPDATE SET direct_count = direct_count + 1", (referrer_id,))
+    row = c.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ? RETURNING *", (referrer_id,)).fetchone()
+    after_commit(_user_written, dict(row))
+    if row["referred_by"] is not None:
+        c.execute("INSERT INTO referral_stats (user_id, depth2_count) VALUES (?, 1) "
+                  "ON CONFLICT(user_id) DO UPDATE SET depth2_count = depth2_count + 1", (row["referred_by"],))
+    credit._tx(c, referrer_id, REFERRAL_BONUS_MICRO, "referral_balance_micro", True, "referral")
+    return True
+
+def get_referral_stats(user_id:int):
+    # -> (direct_count, depth2_count, earnings_micro)
+    c = get_conn().cursor()
+    c.execute("SELECT direct_count, depth2_count, earnings_micro FROM referral_stats WHERE user_id = ?", (user_id,))
+    r = c.fetchone()
+    return tuple(r) if r else (0, 0, 0)
+
+@write_op
+def rebuild_referral_stats(c, after_id:int, limit:int):
+    # recomputes the next keyset window of users -> (referrers, rows changed, last user_id or None when done)
+    ids = [r[0] for r in c.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_id, limit))]
+    hi = ids[-1] if len(ids) == limit else 2 ** 63 - 1    # the last window also clears stale rows past it
+    fresh = {r[0]: (r[1], 0, 0) for r in c.execute(
+        "SELECT user_id, referrals_count FROM users WHERE user_id > ? AND user_id <= ? AND referrals_count > 0", (after_id, hi))}
+    for uid, n, earned in c.execute(
+        "SELECT r.referrer_id, COUNT(*), COALESCE(SUM(u.total_earned_micro), 0) FROM referrals r LEFT JOIN users u ON u.user_id = r.referee_id "
+        "WHERE r.referrer_id > ? AND r.referrer_id <= ? GROUP BY r.referrer_id", (after_id, hi)).fetchall():
+        fresh[uid] = (max(fresh.get(uid, (0,))[0], n), 0, earned)
+    for uid, n in c.execute("SELECT r1.referrer_id, COUNT(*) FROM referrals r1 JOIN referrals r2 ON r2.referrer_id = r1.referee_id "
+                            "WHERE r1.referrer_id > ? AND r1.referrer_id <= ? GROUP BY r1.referrer_id", (after_id, hi)).fetchall():
+        fresh[uid] = (fresh[uid][0], n, fresh[uid][2])
+    old = {r[0]: tuple(r[1:]) for r in c.execute(
+        "SELECT user_id, direct_count, depth2_count, earnings_micro FROM referral_stats WHERE user_id > ? AND user_id <= ?", (after_id, hi))}
+    changed = [uid for uid in fresh.keys() | old.keys() if fresh.get(uid) != old.get(uid)]
+    for uid in changed:
+        if uid in fresh:
+            c.execute("INSERT OR REPLACE INTO referral_stats (user_id, direct_count, depth2_count, earnings_micro) VALUES (?, ?, ?, ?)", (uid, *fresh[uid]))
+        else:
+            c.execute("DELETE FROM referral_stats WHERE user_id = ?", (uid,))
+    return len(fresh), len(changed), (hi if len(ids) == limit else None)
+
+aget_referral_stats = _awaitable(get_referral_stats)
+arebuild_referral_stats = _awaitable(rebuild_referral_stats)
+
+async def rebuild_referrals():
+    t0 = time.perf_counter()
+    referrers = changed = 0; after = 0
+    while after is not None:
+        n, ch, after = await arebuild_referral_stats(after, REFERRAL_REBUILD_CHUNK)
+        referrers += n; changed += ch
+    return {"referrers": referrers, "changed": changed, "seconds": round(time.perf_counter() - t0, 3)}
+
+# -------------------------
+# Background tasks
+# -------------------------
+_background_tasks = set()
+
+def start_background(coro, name:str):
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def stop_background():
+    tasks = list(_background_tasks)
+    for t in tasks: t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 # -------------------------
 # Helpers
@@ -218,7 +1789,8 @@ def micro_to_usd(micro:int) -> str:
     usd = micro * 0.001
     return f"${usd:.4f}"
 
-def make_user_keyboard(user_id:int):
+@functools.lru_cache(maxsize=2)
+def _menu_keyboard(is_admin:bool):
     # 3-per-row layout
     row1 = [
         InlineKeyboardButton("▶ Watch Ad", callback_data="watch_ad"),
@@ -235,64 +1807,726 @@ def make_user_keyboard(user_id:int):
         InlineKeyboardButton("🌐 Earnly Website", callback_data="earnly_website"),
     ]
     kb = [row1, row2, row3]
-    if user_id == ADMIN_ID:
+    if is_admin:
         kb.append([InlineKeyboardButton("🛠 Admin Panel", callback_data="admin_panel")])
     return InlineKeyboardMarkup(kb)
 
+def make_user_keyboard(user_id:int):
+    # markups are immutable: build the user and admin menus once
+    return _menu_keyboard(user_id == ADMIN_ID)
+
+# -------------------------
+# Bot API layer
+# -------------------------
+# EarnlyBot is the ExtBot every handler talks to. It counts calls per API
+# method and per update (see track_api_calls), answers get_me() from the
+# identity fetched at initialize(), and drops editMessageText calls whose
+# text/markup equal what the message already shows (or what an in-flight edit
+# is about to show); "message is not modified" errors are swallowed too.
+# The edit skip is per process, so it's off with several workers (another
+# worker may have changed the message since).
+BOT_EDIT_CACHE_SIZE = int(os.getenv("BOT_EDIT_CACHE_SIZE", "0" if MULTI_WORKER else "20000"))
+
+class BotAPIStats:
+    def __init__(self):
+        self.calls = Counter(); self.errors = Counter(); self.saved = Counter()
+        self.per_update = {}    # label -> [updates, api calls]
+
+    def record_update(self, label:str, calls:int):
+        e = self.per_update.setdefault(label, [0, 0])
+        e[0] += 1; e[1] += calls
+
+    def calls_per_update(self):
+        return {k: round(c / n, 2) for k, (n, c) in self.per_update.items() if n}
+
+api_stats = BotAPIStats()
+_update_api_calls = contextvars.ContextVar("update_api_calls", default=None)
+
+def update_label(update) -> str:
+    q = getattr(update, "callback_query", None)
+    if q is not None and q.data:
+        return q.data.split(":", 1)[0]
+    msg = getattr(update, "message", None)
+    if msg is not None and msg.text and msg.text.startswith("/"):
+        return msg.text.split()[0][1:].split("@", 1)[0]
+    return "other"
+
+def track_api_calls(handler):
+    # wraps a PTB callback: counts the Bot API calls made while handling one update
+    # and times it (earnly_update_seconds, labelled like the per-update stats)
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        counter = [0]
+        token = _update_api_calls.set(counter)
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            res = await handler(update, context)
+            failed = False
+            return res
+        finally:
+            _update_api_calls.reset(token)
+            label = update_label(update)
+            api_stats.record_update(label, counter[0])
+            update_seconds.observe(label, time.perf_counter() - t0)
+            if failed: update_errors.inc(label)
+    return wrapper
+
+class EarnlyBot(ExtBot):
+    def __init__(self, *args, **kwargs):
+        self._last_edit = OrderedDict()   # (chat_id, message_id, inline_id) -> (text, parse_mode, markup)
+        super().__init__(*args, **kwargs)
+
+    async def get_me(self, *args, **kwargs):
+        if self._bot_user is not None and not args and not kwargs:
+            api_stats.saved["getMe"] += 1
+            return self._bot_user
+        return await super().get_me(*args, **kwargs)
+
+    async def _do_post(self, endpoint, data, *args, **kwargs):
+        key = fp = None
+        if endpoint == "editMessageText" and BOT_EDIT_CACHE_SIZE > 0:
+            key = (data.get("chat_id"), data.get("message_id"), data.get("inline_message_id"))
+            fp = (data.get("text"), data.get("parse_mode"), data.get("reply_markup"))
+            if self._last_edit.get(key) == fp:
+                api_stats.saved[endpoint] += 1
+                return True
+            self._remember_edit(key, fp)
+        api_stats.calls[endpoint] += 1
+        counter = _update_api_calls.get()
+        if counter is not None: counter[0] += 1
+        t0 = time.perf_counter()
+        try:
+            return await super()._do_post(endpoint, data, *args, **kwargs)
+        except BadRequest as e:
+            if key is not None and "not modified" in str(e).lower():
+                api_stats.saved[endpoint] += 1
+                return True
+            if key is not None: self._last_edit.pop(key, None)
+            api_stats.errors[endpoint] += 1; bot_api_errors.inc((endpoint, type(e).__name__))
+            raise
+        except TelegramError as e:
+            if key is not None: self._last_edit.pop(key, None)
+            api_stats.errors[endpoint] += 1; bot_api_errors.inc((endpoint, type(e).__name__))
+            raise
+        finally:
+            bot_api_seconds.observe(endpoint, time.perf_counter() - t0)
+
+    def _remember_edit(self, key, fp):
+        self._last_edit[key] = fp
+        self._last_edit.move_to_end(key)
+        while len(self._last_edit) > BOT_EDIT_CACHE_SIZE:
+            self._last_edit.popitem(last=False)
+
+# -------------------------
+# Outbound Telegram sender
+# -------------------------
+# Shared by broadcasts and bulk notifications: a global token bucket (Telegram
+# allows ~30 msg/s per bot), a minimum interval per chat (~1 msg/s), and
+# RetryAfter handling that pauses the whole bucket, not just one task.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_PER_CHAT_INTERVAL = float(os.getenv("TG_PER_CHAT_INTERVAL", "1.0"))
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "3"))
+
+def _seconds(v) -> float:
+    # RetryAfter.retry_after is an int or a timedelta depending on the PTB version
+    return v.total_seconds() if hasattr(v, "total_seconds") else float(v)
+
+class TokenBucket:
+    def __init__(self, rate:float, capacity:Optional[float]=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds:float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now); continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TelegramSender:
+    def __init__(self, rate:float=TG_GLOBAL_RATE, per_chat_interval:float=TG_PER_CHAT_INTERVAL, retries:int=TG_SEND_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.retries = retries
+        self._next_for_chat = {}
+
+    async def _chat_slot(self, chat_id:int):
+        now = time.monotonic()
+        if len(self._next_for_chat) > 10000:
+            self._next_for_chat = {k: v for k, v in self._next_for_chat.items() if v > now}
+        at = self._next_for_chat.get(chat_id, 0.0)
+        self._next_for_chat[chat_id] = max(at, now) + self.per_chat_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def send(self, bot, chat_id:int, text:str, **kwargs) -> str:
+        # -> "sent" | "blocked" | "failed"
+        for attempt in range(self.retries + 1):
+            await self._chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return "sent"
+            except RetryAfter as e:
+                wait = _seconds(e.retry_after)
+                self.bucket.pause(wait)
+                await asyncio.sleep(wait)
+            except Forbidden:
+                return "blocked"
+            except BadRequest:
+                return "failed"
+            except NetworkError:
+                await asyncio.sleep(1 + attempt)
+            except TelegramError:
+                return "failed"
+        return "failed"
+
+tg_sender = TelegramSender()
+
+# -------------------------
+# Broadcast engine
+# -------------------------
+# /admin_broadcast creates a job row and returns immediately. The job streams
+# recipients from users in keyset pages, sends with bounded concurrency through
+# tg_sender, records every recipient in broadcast_deliveries (group-committed)
+# and advances cursor_user_id once a page is done. Jobs still 'running' at
+# startup are resumed; recipients already delivered are skipped.
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "15"))
+
+@write_op
+def create_broadcast(c, text:str, admin_chat_id:int, total:int):
+    c.execute("INSERT INTO broadcasts (text, status, admin_chat_id, total, created_at) VALUES (?, 'running', ?, ?, ?)",
+              (text, admin_chat_id, total, int(time.time())))
+    return c.lastrowid
+
+@write_op
+def set_broadcast_message(c, bid:int, message_id:int):
+    c.execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?", (message_id, bid))
+
+@write_op
+def record_delivery(c, bid:int, user_id:int, status:str):
+    if status not in ("sent", "failed", "blocked"): status = "failed"
+    c.execute("INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status, sent_at) VALUES (?, ?, ?, ?)",
+              (bid, user_id, status, int(time.time())))
+    if c.rowcount == 1:
+        c.execute(f"UPDATE broadcasts SET {status} = {status} + 1 WHERE id = ?", (bid,))
+
+@write_op
+def advance_broadcast(c, bid:int, cursor_user_id:int):
+    c.execute("UPDATE broadcasts SET cursor_user_id = ? WHERE id = ?", (cursor_user_id, bid))
+
+@write_op
+def finish_broadcast(c, bid:int, status:str="done"):
+    c.execute("UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'", (status, int(time.time()), bid))
+    return c.rowcount == 1
+
+def get_broadcast(bid:int):
+    c = get_conn().cursor()
+    c.execute("SELECT * FROM broadcasts WHERE id = ?", (bid,))
+    return c.fetchone()
+
+def running_broadcasts():
+    c = get_conn().cursor()
+    c.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return [r["id"] for r in c.fetchall()]
+
+def broadcast_page(bid:int, after_user_id:int, limit:int):
+    # next page of recipients not yet delivered for this broadcast
+    c = get_conn().cursor()
+    c.execute("""SELECT u.user_id FROM users u WHERE u.user_id > ? AND NOT EXISTS
+                 (SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = ? AND d.user_id = u.user_id)
+                 ORDER BY u.user_id LIMIT ?""", (after_user_id, bid, limit))
+    return [r["user_id"] for r in c.fetchall()]
+
+acreate_broadcast = _awaitable(create_broadcast)
+aset_broadcast_message = _awaitable(set_broadcast_message)
+arecord_delivery = _awaitable(record_delivery)
+aadvance_broadcast = _awaitable(advance_broadcast)
+afinish_broadcast = _awaitable(finish_broadcast)
+aget_broadcast = _awaitable(get_broadcast)
+arunning_broadcasts = _awaitable(running_broadcasts)
+abroadcast_page = _awaitable(broadcast_page)
+
+_broadcast_tasks = {}
+
+def _broadcast_report(b, status:str, rate:float) -> str:
+    done = b["sent"] + b["failed"] + b["blocked"]
+    return (f"📣 Broadcast #{b['id']} {status}\n"
+            f"Sent: {b['sent']} | Failed: {b['failed']} | Blocked: {b['blocked']}\n"
+            f"Progress: {done}/{b['total']} | {rate:.1f} msg/s")
+
+async def _report_broadcast(bot, bid:int, status:str, rate:float):
+    b = await aget_broadcast(bid)
+    if not b or not b["admin_chat_id"]: return
+    text = _broadcast_report(b, status, rate)
+    try:
+        if b["progress_message_id"]:
+            await bot.edit_message_text(text, chat_id=b["admin_chat_id"], message_id=b["progress_message_id"])
+        else:
+            msg = await bot.send_message(b["admin_chat_id"], text)
+            await aset_broadcast_message(bid, msg.message_id)
+    except TelegramError as e:
+        print(f"Broadcast #{bid} progress report failed:", e)
+
+async def run_broadcast(bot, bid:int):
+    b = await aget_broadcast(bid)
+    if not b or b["status"] != "running": return
+    text = b["text"]; cursor = b["cursor_user_id"] or 0
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = time.monotonic(); handled = 0; last_report = 0.0
+
+    async def deliver(user_id:int):
+        nonlocal handled
+        async with sem:
+            status = await tg_sender.send(bot, user_id, text)
+        await arecord_delivery(bid, user_id, status)
+        handled += 1
+
+    try:
+        while True:
+            ids = await abroadcast_page(bid, cursor, BROADCAST_PAGE_SIZE)
+            if not ids: break
+            await asyncio.gather(*(deliver(u) for u in ids))
+            cursor = ids[-1]
+            await aadvance_broadcast(bid, cursor)
+            if (await aget_broadcast(bid))["status"] != "running":
+                return
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_SECONDS:
+                last_report = time.monotonic()
+                await _report_broadcast(bot, bid, "running", handled / max(last_report - started, 1e-6))
+        await afinish_broadcast(bid, "done")
+        await _report_broadcast(bot, bid, "done", handled / max(time.monotonic() - started, 1e-6))
+    finally:
+        _broadcast_tasks.pop(bid, None)
+
+def start_broadcast_task(bot, bid:int):
+    if bid not in _broadcast_tasks:
+        _broadcast_tasks[bid] = asyncio.create_task(run_broadcast(bot, bid))
+    return _broadcast_tasks[bid]
+
+async def resume_broadcasts(bot):
+    # leader only: jobs left running by a previous process or queued by a follower
+    for bid in await arunning_broadcasts():
+        if bid in _broadcast_tasks: continue
+        print(f"Resuming broadcast #{bid}")
+        start_broadcast_task(bot, bid)
+
+async def stop_broadcasts():
+    # jobs stay 'running' in the DB and resume on next startup
+    tasks = list(_broadcast_tasks.values())
+    for t in tasks: t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# -------------------------
+# Webhook ingestion
+# -------------------------
+# The webhook decodes with orjson when installed, drops update_ids seen in the
+# last WEBHOOK_DEDUP_WINDOW updates (Telegram redelivers after slow replies),
+# and admits at most UPDATE_MAX_PENDING updates that are queued or in
+# processing; past that it answers 200 right away and drops the update rather
+# than letting Telegram time out. PTB then runs up to UPDATE_CONCURRENCY
+# updates at once, but updates of the same user keep their arrival order.
+WEBHOOK_DEDUP_WINDOW = int(os.getenv("WEBHOOK_DEDUP_WINDOW", "20000"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "1000"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "2000"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+class WebhookIngest:
+    def __init__(self, window:int=WEBHOOK_DEDUP_WINDOW, max_pending:int=UPDATE_MAX_PENDING):
+        self.window = window; self.max_pending = max_pending
+        self._seen = set(); self._order = deque()
+        self.pending = 0
+        self.received = 0; self.duplicates = 0; self.dropped = 0
+
+    def admit(self, update_id) -> bool:
+        # False: duplicate or overloaded, answer 200 and skip it
+        self.received += 1
+        if update_id is not None:
+            if update_id in self._seen:
+                self.duplicates += 1; return False
+            self._seen.add(update_id); self._order.append(update_id)
+            if len(self._order) > self.window:
+                self._seen.discard(self._order.popleft())
+        if self.pending >= self.max_pending:
+            self.dropped += 1; return False
+        self.pending += 1
+        return True
+
+    def done(self):
+        if self.pending > 0: self.pending -= 1
+
+    def reject(self, update_id):
+        # admitted but never handed to PTB: free the pending slot and the dedup entry
+        self.done()
+        self._seen.discard(update_id)
+
+    def stats(self):
+        return {"received": self.received, "duplicates": self.duplicates, "dropped": self.dropped, "pending": self.pending}
+
+webhook_ingest = WebhookIngest()
+
+def _update_key(update):
+    user = getattr(update, "effective_user", None)
+    if user is not None: return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # PTB's own semaphore is sized past UPDATE_MAX_PENDING so it never waits;
+    # the real limit is _slots, taken only after the user's lock: updates queued
+    # behind the same user's earlier one don't hold a slot, so a burst from one
+    # user can't stall everyone else
+    def __init__(self, max_concurrent_updates:int):
+        super().__init__(max(max_concurrent_updates, UPDATE_MAX_PENDING))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}    # key -> [asyncio.Lock, users of the lock]
+
+    async def do_process_update(self, update, coroutine):
+        key = _update_key(update)
+        try:
+            if key is None:
+                async with self._slots:
+                    await coroutine
+                return
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:    # FIFO: same-user updates run in order
+                    async with self._slots:
+                        await coroutine
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0: self._locks.pop(key, None)
+        finally:
+            webhook_ingest.done()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+_OK_RESPONSE = b'{"ok":true}'
+
 # -------------------------
 # App + Telegram Application
 # -------------------------
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
 application: Optional[Application] = None
 
+# scrape-time gauges over the stats the components already keep
+metrics.gauge("earnly_update_queue_depth", "Updates waiting in PTB's update_queue.",
+              lambda: application.update_queue.qsize() if application else None)
+metrics.gauge("earnly_updates_pending", "Updates admitted by the webhook and not finished yet.", lambda: webhook_ingest.pending)
+metrics.gauge("earnly_webhook_updates_total", "Webhook updates by outcome.", lambda: {
+    "received": webhook_ingest.received, "duplicate": webhook_ingest.duplicates, "dropped": webhook_ingest.dropped},
+    label="outcome", kind="counter")
+metrics.gauge("earnly_db_write_queue_depth", "Ops waiting for the group-commit writer.", lambda: db_writer.stats()["queue_depth"])
+metrics.gauge("earnly_db_write_batches_total", "Group-commit batches committed.", lambda: db_writer.batches, kind="counter")
+metrics.gauge("earnly_bot_api_calls_total", "Bot API calls sent, by method.", lambda: dict(api_stats.calls), label="method", kind="counter")
+metrics.gauge("earnly_bot_api_saved_total", "Bot API calls avoided (cached getMe, unchanged edits), by method.",
+              lambda: dict(api_stats.saved), label="method", kind="counter")
+metrics.gauge("earnly_user_cache_rows", "Rows in the user cache.", lambda: user_cache.stats()["size"])
+metrics.gauge("earnly_user_cache_lookups_total", "User cache lookups by result.",
+              lambda: {"hit": user_cache.hits, "miss": user_cache.misses}, label="result", kind="counter")
+metrics.gauge("earnly_click_tokens", "Live click tokens held in memory.", lambda: click_store.stats()["size"])
+metrics.gauge("earnly_rate_limited_total", "Requests turned away by the rate limiters.", lambda: {
+    "v_user": v_user_limiter.rejected, "v_ip": v_ip_limiter.rejected, "callback": callback_limiter.rejected},
+    label="limiter", kind="counter")
+metrics.gauge("earnly_velocity_flags", "Users currently in the flagged list.", lambda: len(velocity.flagged))
+metrics.gauge("earnly_broadcasts_running", "Broadcast jobs running in this process.", lambda: len(_broadcast_tasks))
+
+# -------------------------
+# Worker coordination
+# -------------------------
+# Every worker runs PTB and serves every route against the shared database.
+# Exactly one, the leader, holds an exclusive flock on <DB_PATH>.leader and
+# owns what must happen once: registering the webhook, running broadcasts and
+# the retention job. Followers retry the lock every LEADER_POLL_SECONDS, so when
+# the leader exits (the OS drops the lock of a crashed process too) another
+# worker takes over. The leader also starts broadcasts queued by followers.
+# Each worker also holds a flock on <DB_PATH>.leader.<pid>; a worker that finds
+# another live one while not in multi-worker mode warns and switches to it.
+LEADER_POLL_SECONDS = float(os.getenv("LEADER_POLL_SECONDS", "10"))
+
+try:
+    import fcntl
+except ImportError:     # no flock (Windows): every process leads, run a single worker
+    fcntl = None
+
+class LeaderLock:
+    def __init__(self, path:Optional[str]):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None: return True
+        if self.path is None or fcntl is None:
+            self._fd = -1; return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd); return False
+        os.ftruncate(fd, 0); os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None and self._fd >= 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN); os.close(self._fd)
+        self._fd = None
+
+leader = LeaderLock(storage.leader_lock_path())
+
+class WorkerRegistry:
+    # one locked file per live worker; a file whose lock can be taken belongs
+    # to a process that is gone and is removed
+    def __init__(self, lock_path:Optional[str]):
+        self.prefix = f"{lock_path}." if lock_path and fcntl else None
+        self._fd = None
+
+    def register(self):
+        if self.prefix is None or self._fd is not None: return
+        fd = os.open(f"{self.prefix}{os.getpid()}", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._fd = fd
+
+    def others(self) -> int:
+        if self.prefix is None: return 0
+        d, base = os.path.split(self.prefix)
+        n = 0
+        for name in os.listdir(d or "."):
+            if not name.startswith(base) or not name[len(base):].isdigit() or int(name[len(base):]) == os.getpid(): continue
+            path = os.path.join(d, name)
+            try: fd = os.open(path, os.O_RDWR)
+            except OSError: continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                n += 1      # held: a live worker
+            else:
+                try: os.unlink(path)
+                except OSError: pass
+            finally:
+                os.close(fd)
+        return n
+
+    def unregister(self):
+        if self._fd is None: return
+        try: os.unlink(f"{self.prefix}{os.getpid()}")
+        except OSError: pass
+        os.close(self._fd); self._fd = None
+
+workers = WorkerRegistry(storage.leader_lock_path())
+
+def enable_multi_worker(reason:str):
+    # another process serves the same database: turn off what MULTI_WORKER
+    # would have turned off at import (settings given explicitly are kept)
+    global MULTI_WORKER, BOT_EDIT_CACHE_SIZE
+    if MULTI_WORKER: return
+    MULTI_WORKER = True
+    print(f"WARNING: {reason}; worker {os.getpid()} switches to multi-worker mode. "
+          "Set WEB_CONCURRENCY=N (or MULTI_WORKER=1) so workers start that way.")
+    if "USER_CACHE_SIZE" not in os.environ:
+        user_cache.maxsize = 0; user_cache.invalidate()
+    if "LEADERBOARD_TTL" not in os.environ:
+        leaderboard.ttl = 30; leaderboard.invalidate()
+    if "BOT_EDIT_CACHE_SIZE" not in os.environ:
+        BOT_EDIT_CACHE_SIZE = 0
+
+async def ensure_webhook(bot):
+    # getWebhookInfo first: a restart with the same URL keeps the registration
+    # (and Telegram's queue of pending updates) instead of resetting it
+    webhook_url = f"{BASE_URL.rstrip('/')}/webhook/{BOT_TOKEN}"
+    try:
+        info = await bot.get_webhook_info()
+        if info.url == webhook_url:
+            print(f"Webhook already set ({info.pending_update_count} pending)"); return
+        await bot.set_webhook(webhook_url)
+        print("Webhook set to:", webhook_url)
+    except Exception as e:
+        print("Failed to set webhook:", e)
+
+async def _lead(bot):
+    # once, when this worker becomes the leader
+    await ensure_webhook(bot)
+    start_background(click_retention_loop(), "click-retention")
+
+async def leader_loop(bot):
+    while True:
+        try:
+            if not MULTI_WORKER and workers.others():
+                enable_multi_worker("another worker serves this database")
+            if not leader.held and leader.try_acquire():
+                if MULTI_WORKER: print(f"Worker {os.getpid()} is the leader")
+                await _lead(bot)
+            if leader.held:
+                await resume_broadcasts(bot)
+        except Exception as e:
+            print("Leader loop failed:", e)
+        await asyncio.sleep(LEADER_POLL_SECONDS)
+
+# -------------------------
+# Startup + shutdown
+# -------------------------
+# Shutdown drains before it tears down: the webhook answers 503 from then on
+# (Telegram keeps those updates and redelivers them to the next process),
+# admitted updates get up to SHUTDOWN_DRAIN_SECONDS to finish, and only then
+# are broadcasts stopped and the writer flushed. Both phases print their timings.
+# The webhook stays registered, so the next start skips setWebhook and Telegram
+# can wake an idle instance; DELETE_WEBHOOK_ON_SHUTDOWN=1 deletes it instead.
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+DELETE_WEBHOOK_ON_SHUTDOWN = os.getenv("DELETE_WEBHOOK_ON_SHUTDOWN", "0") == "1"
+
+draining = False
+
+def _ms(t0:float) -> str:
+    return f"{(time.perf_counter() - t0) * 1000:.0f}ms"
+
+async def drain_updates(deadline:float) -> int:
+    # wait for admitted updates to finish; past the deadline the ones still
+    # queued are discarded. Returns how many were discarded.
+    while webhook_ingest.pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    lost = 0
+    if application:
+        q = application.update_queue
+        while True:
+            try: q.get_nowait()
+            except asyncio.QueueEmpty: break
+            q.task_done(); webhook_ingest.done(); lost += 1
+    return lost
+
 @app.on_event("startup")
 async def startup():
-    global application
-    init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
+    global application, draining
+    t0 = time.perf_counter(); draining = False
+    applied = await ainit_db()
+    t_db = _ms(t0)
+    db_writer.start()
+    application = (Application.builder().bot(EarnlyBot(BOT_TOKEN, base_url=f"{TELEGRAM_API_URL.rstrip('/')}/bot"))
+                   .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_MAX))
+                   .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+                   .build())
     # register handlers
     application.add_handler(CommandHandler("start", cmd_start))
     application.add_handler(CallbackQueryHandler(on_button))
     application.add_handler(CommandHandler("admin_broadcast", admin_broadcast))
     application.add_handler(CommandHandler("admin_stats", admin_stats))
-    # start PTB & set webhook to /webhook/<token>
+    application.add_handler(CommandHandler("admin_broadcast_cancel", admin_broadcast_cancel))
+    application.add_handler(CommandHandler("admin_leaderboard_check", admin_leaderboard_check))
+    application.add_handler(CommandHandler("admin_approve_under", admin_approve_under))
+    application.add_handler(CommandHandler("admin_reconcile", admin_reconcile))
+    application.add_handler(CommandHandler("admin_rebuild_referrals", admin_rebuild_referrals))
+    # start PTB; the leader sets the webhook to /webhook/<token>
     await application.initialize()
     await application.start()
-    webhook_url = f"{BASE_URL.rstrip('/')}/webhook/{BOT_TOKEN}"
-    try:
-        await application.bot.set_webhook(webhook_url)
-        print("Webhook set to:", webhook_url)
-    except Exception as e:
-        print("Failed to set webhook:", e)
+    t_bot = _ms(t0)
+    workers.register()
+    if not MULTI_WORKER and workers.others():
+        enable_multi_worker("another worker serves this database")
+    if leader.try_acquire():
+        await _lead(application.bot)
+    start_background(leader_loop(application.bot), "leader")
+    print(f"Startup: {_ms(t0)} (schema {t_db}{f', migrated {applied}' if applied else ''}, "
+          f"bot ready {t_bot}, {'leader' if leader.held else 'follower'})")
 
 @app.on_event("shutdown")
 async def shutdown():
-    global application
+    global application, draining
+    t0 = time.perf_counter()
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+    draining = True
+    pending = webhook_ingest.pending
+    lost = await drain_updates(deadline)
+    running = webhook_ingest.pending
+    t_drain = _ms(t0)
+    await stop_broadcasts()
+    await stop_background()
     if application:
+        if leader.held and DELETE_WEBHOOK_ON_SHUTDOWN:
+            try:
+                await application.bot.delete_webhook()
+            except:
+                pass
         try:
-            await application.bot.delete_webhook()
-        except:
+            # PTB waits for updates still in processing; bounded by the deadline
+            await asyncio.wait_for(application.stop(), max(1.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
             pass
-        await application.stop()
         await application.shutdown()
+    leader.release(); workers.unregister()
+    t1 = time.perf_counter()
+    writes = db_writer.stats()["queue_depth"]
+    flushed = db_writer.stop(max(1.0, deadline - time.monotonic()))
+    t_flush = _ms(t1)
+    close_db()
+    print(f"Shutdown: {_ms(t0)} (drained {pending - lost - running} updates in {t_drain}"
+          f"{f', discarded {lost} queued' if lost else ''}{f', abandoned {running} running' if running else ''}, "
+          f"{'flushed' if flushed else 'gave up flushing'} {writes} writes in {t_flush})")
 
 # Telegram webhook receiver
 @app.post("/webhook/{token}")
 async def telegram_webhook(token: str, request: Request):
     if token != BOT_TOKEN:
         raise HTTPException(status_code=403, detail="Invalid token")
-    data = await request.json()
-    upd = Update.de_json(data, application.bot)
-    # hand to PTB
-    await application.update_queue.put(upd)
-    return JSONResponse({"ok": True})
+    if draining:
+        # not 200: Telegram retries it, and the next process handles it
+        return PlainTextResponse("Shutting down", status_code=503)
+    try:
+        data = json_loads(await request.body())
+    except ValueError:
+        return PlainTextResponse("Bad JSON", status_code=400)
+    if not isinstance(data, dict) or not webhook_ingest.admit(data.get("update_id")):
+        return Response(_OK_RESPONSE, media_type="application/json")
+    # hand to PTB without waiting: a full queue drops the update
+    try:
+        upd = Update.de_json(data, application.bot)
+        application.update_queue.put_nowait(upd)
+    except asyncio.QueueFull:
+        webhook_ingest.done(); webhook_ingest.dropped += 1
+    except Exception as e:
+        webhook_ingest.reject(data.get("update_id"))
+        print("Bad webhook update:", e)
+        return PlainTextResponse("Bad update", status_code=400)
+    return Response(_OK_RESPONSE, media_type="application/json")
 
 # Tracking link endpoint: /v?t=TOKEN&user=USERID
 @app.get("/v")
-async def track_and_redirect(t: str = "", user: Optional[int] = None):
+async def track_and_redirect(request: Request, t: str = "", user: Optional[int] = None):
+    # rate limits first: a flood is turned away before it costs a write
+    limiter = None
+    if not v_ip_limiter.hit(client_ip(request)): limiter = v_ip_limiter
+    elif user and not v_user_limiter.hit(user): limiter = v_user_limiter
+    if limiter is not None:
+        if user: note_velocity(user, "rate_limited")
+        return too_many(limiter.window)
     # record click for the user if provided
     if user:
-        record_click(user, t or "none")
+        click_store.record(user, t or "none")
+        note_velocity(user, "click")
     # redirect to offerwall DIRECT (for ad rotation you can extend)
     target = OFFERWALL_DIRECT
     sep = "&" if "?" in target else "?"
@@ -300,23 +2534,339 @@ async def track_and_redirect(t: str = "", user: Optional[int] = None):
         target = f"{target}{sep}subid={user}"
     return RedirectResponse(url=target)
 
+def amount_to_micro(amount) -> Optional[int]:
+    # provider USD amount -> micro (1 micro = $0.001); None unless finite and in [0, 1e6)
+    # (NaN fails the comparison too)
+    if amount is None or not (0 <= amount < 1e6): return None
+    return int(round(amount / 0.001))
+
 # Postback endpoint to receive offerwall/CPA credits
-# Example: /postback?subid=123&amount=0.50
+# Example: /postback?subid=123&amount=0.50&txid=abc
+# txid (or transaction_id) is required: it is what makes a provider's retry a
+# no-op. A callback without one is refused (400) rather than credited blind;
+# configure the provider's postback URL to pass its transaction id.
 @app.get("/postback")
-async def postback(subid: Optional[int] = None, amount: Optional[float] = 0.0):
+async def postback(subid: Optional[int] = None, amount: Optional[float] = 0.0, txid: Optional[str] = None,
+                   transaction_id: Optional[str] = None):
     if not subid:
         return PlainTextResponse("Missing subid", status_code=400)
-    # Convert USD to micro (1 micro = $0.001)
-    micro = int(round(amount / 0.001))
-    ensure_user(subid)
-    # credit 80% to user offer_balance, owner 20% kept (owner accounting optional)
-    user_share = int(round(micro * 0.80))
-    credit(subid, user_share, field="offer_balance_micro", add_total=True, tx_type="offer")
+    txid = txid or transaction_id
+    if not txid or len(txid) > 128:
+        return PlainTextResponse("Missing txid", status_code=400)
+    micro = amount_to_micro(amount)
+    if micro is None:
+        return PlainTextResponse("Invalid amount", status_code=400)
+    await aapply_postbacks([(txid, subid, micro)])
+    # duplicates answer OK too, so the provider stops retrying
     return PlainTextResponse("OK")
 
+# Bulk postback: POST {"conversions": [{"txid": "...", "subid": 123, "amount": 0.5}, ...]}
+# (a bare list works too). One transaction per request; per-item results.
+# The body must be signed: X-Postback-Signature = hex HMAC-SHA256 of the raw
+# body with POSTBACK_SECRET (shared with the provider). Off (404) while unset.
+POSTBACK_MAX_BATCH = int(os.getenv("POSTBACK_MAX_BATCH", "1000"))
+
+def _parse_conversion(item):
+    # -> (txid, user_id, amount_micro) or an error string
+    if not isinstance(item, dict): return "not an object"
+    txid = item.get("txid") or item.get("transaction_id")
+    if not isinstance(txid, (str, int)) or isinstance(txid, bool) or not str(txid) or len(str(txid)) > 128:
+        return "missing or invalid txid"
+    try:
+        user_id = int(item.get("subid"))
+        amount = float(item.get("amount", 0))
+    except (TypeError, ValueError):
+        return "invalid subid or amount"
+    if user_id <= 0: return "invalid subid"
+    micro = amount_to_micro(amount)
+    if micro is None: return "invalid amount"
+    return (str(txid), user_id, micro)
+
+def postback_signature_ok(raw:bytes, signature:str) -> bool:
+    expected = hmac.new(POSTBACK_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+@app.post("/postback")
+async def postback_bulk(request: Request):
+    if not POSTBACK_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+    raw = await request.body()
+    if not postback_signature_ok(raw, request.headers.get("x-postback-signature", "")):
+        return JSONResponse({"ok": False, "error": "invalid signature"}, status_code=403)
+    try:
+        body = json_loads(raw)
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "bad JSON"}, status_code=400)
+    items = body.get("conversions") if isinstance(body, dict) else body
+    if not isinstance(items, list):
+        return JSONResponse({"ok": False, "error": "expected a list of conversions"}, status_code=400)
+    if len(items) > POSTBACK_MAX_BATCH:
+        return JSONResponse({"ok": False, "error": f"at most {POSTBACK_MAX_BATCH} conversions per request"}, status_code=413)
+    parsed = [_parse_conversion(it) for it in items]
+    valid = [p for p in parsed if isinstance(p, tuple)]
+    applied = iter(await aapply_postbacks(valid) if valid else [])
+    results = []; counts = Counter()
+    for it, p in zip(items, parsed):
+        txid = (it.get("txid") or it.get("transaction_id")) if isinstance(it, dict) else None
+        if isinstance(p, str):
+            results.append({"txid": txid, "status": "invalid", "error": p}); counts["invalid"] += 1
+            continue
+        status, share = next(applied)
+        results.append({"txid": p[0], "status": status, "credited_micro": share}); counts[status] += 1
+    return JSONResponse({"ok": True, "credited": counts["credited"], "duplicates": counts["duplicate"],
+                         "invalid": counts["invalid"], "results": results})
+
+# -------------------------
+# Metrics + debug routes
+# -------------------------
+def admin_key_ok(request: Request) -> bool:
+    # X-Admin-Key header or "Authorization: Bearer <key>"
+    if not ADMIN_API_KEY: return False
+    got = request.headers.get("x-admin-key", "")
+    auth = request.headers.get("authorization", "")
+    if not got and auth[:7].lower() == "bearer ": got = auth[7:].strip()
+    return secrets.compare_digest(got.encode(), ADMIN_API_KEY.encode())
+
+def require_admin_key(request: Request):
+    # admin HTTP routes are off (404) until ADMIN_API_KEY is set
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not admin_key_ok(request):
+        raise HTTPException(status_code=403, detail="Invalid admin key")
+
+# Prometheus scrape target; open unless ADMIN_API_KEY is set (then send it as a bearer token)
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if ADMIN_API_KEY and not admin_key_ok(request):
+        raise HTTPException(status_code=403, detail="Invalid admin key")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Hot stacks of every thread over the next N seconds: /debug/profile?seconds=10
+# (threads parked waiting for work are left out unless idle=1)
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 5.0, idle: bool = False):
+    require_admin_key(request)
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        # sampled from a worker thread, so the event loop shows up as it really runs
+        stacks, samples = await asyncio.to_thread(sample_stacks, seconds, idle=idle)
+    finally:
+        _profile_lock.release()
+    return PlainTextResponse(profile_report(stacks, samples))
+
+# -------------------------
+# Exports
+# -------------------------
+# GET /admin/export/{transactions|withdraws|users}.{csv|ndjson} (ADMIN_API_KEY)
+# streams a table for accounting. Rows are read in EXPORT_CHUNK-row keyset
+# pages on the DB pool (each page encoded there too), and the next page is
+# fetched only once the client has taken the previous one, so memory stays
+# flat and the event loop never runs a query. Pages are separate reads, not
+# one snapshot: rows committed mid-export may or may not be included.
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "5000"))
+
+# name -> (table, keyset columns, time column, type column, exported columns)
+EXPORTS = {
+    "transactions": ("transactions", ("created_at", "id"), "created_at", "type",
+                     ("id", "user_id", "type", "amount_micro", "created_at")),
+    "withdraws": ("withdraws", ("id",), "requested_at", "status",
+                  ("id", "user_id", "amount_micro", "status", "requested_at")),
+    "users": ("users", ("user_id",), None, None,
+              ("user_id", "username", "balance_micro", "ad_balance_micro", "offer_balance_micro", "referral_balance_micro",
+               "total_earned_micro", "referrals_count", "referred_by", "last_daily_bonus", "last_reset_date", "ads_today")),
+}
+EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+def _export_encode(rows, columns, fmt:str, header:bool) -> bytes:
+    if fmt == "csv":
+        import csv      # only exports need it; kept off the startup path
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator="\n")
+        if header: w.writerow(columns)
+        w.writerows(rows)
+        return buf.getvalue().encode()
+    if orjson is not None:
+        return b"".join(orjson.dumps(dict(zip(columns, r))) + b"\n" for r in rows)
+    return "".join(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + "\n" for r in rows).encode()
+
+def export_chunk(name:str, fmt:str, after, since:Optional[int], until:Optional[int], kind:Optional[str], limit:int, header:bool):
+    # one keyset page -> (encoded bytes, key of the last row or None when done)
+    table, keys, time_col, type_col, columns = EXPORTS[name]
+    where, params = [], []
+    if after is not None:
+        where.append(f"({', '.join(keys)}) > ({', '.join('?' * len(keys))})"); params += list(after)
+    if since is not None:
+        where.append(f"{time_col} >= ?"); params.append(since)
+    if until is not None:
+        where.append(f"{time_col} < ?"); params.append(until)
+    if kind is not None:
+        where.append(f"{type_col} = ?"); params.append(kind)
+    sql = f"SELECT {', '.join(columns)} FROM {table}"
+    if where: sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {', '.join(keys)} LIMIT ?"
+    rows = get_conn().execute(sql, params + [limit]).fetchall()
+    body = _export_encode([tuple(r) for r in rows], columns, fmt, header)
+    last = tuple(rows[-1][k] for k in keys) if len(rows) == limit else None
+    return body, last
+
+def _parse_time(v:Optional[str]) -> Optional[int]:
+    # unix seconds or an ISO date/datetime (UTC when no offset is given)
+    if v is None or v == "": return None
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(v.replace("Z", "+00:00"))
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+@app.get("/admin/export/{table}.{fmt}")
+async def admin_export(request: Request, table: str, fmt: str, since: Optional[str] = None, until: Optional[str] = None,
+                       kind: Optional[str] = Query(None, alias="type")):
+    require_admin_key(request)
+    if table not in EXPORTS or fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    _, _, time_col, type_col, _ = EXPORTS[table]
+    try:
+        t0, t1 = _parse_time(since), _parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since/until: unix seconds or ISO date")
+    if ((t0 is not None or t1 is not None) and time_col is None) or (kind is not None and type_col is None):
+        raise HTTPException(status_code=400, detail=f"{table} has no time/type filter")
+
+    async def stream():
+        after = None; header = True
+        while True:
+            body, after = await run_db(export_chunk, table, fmt, after, t0, t1, kind, EXPORT_CHUNK, header)
+            header = False
+            if body: yield body
+            if after is None: break
+
+    filename = f"earnly-{table}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}"
+    return StreamingResponse(stream(), media_type=EXPORT_FORMATS[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# -------------------------
+# Withdraw review
+# -------------------------
+# The admin pages through the pending queue by id (keyset, WITHDRAW_PAGE_SIZE
+# at a time) and settles a whole page, or everything up to $X, in one writer
+# transaction per WITHDRAW_BULK_MAX requests. User notifications then go out
+# in the background through tg_sender instead of one await per approval.
+WITHDRAW_PAGE_SIZE = int(os.getenv("WITHDRAW_PAGE_SIZE", "10"))
+WITHDRAW_BULK_MAX = int(os.getenv("WITHDRAW_BULK_MAX", "500"))
+WITHDRAW_BULK_UNDER_USD = float(os.getenv("WITHDRAW_BULK_UNDER_USD", "5"))   # "approve all under $X" button
+WITHDRAW_NOTIFY_CONCURRENCY = int(os.getenv("WITHDRAW_NOTIFY_CONCURRENCY", "20"))
+
+async def _send_withdraw_notices(bot, rows, status:str):
+    sem = asyncio.Semaphore(WITHDRAW_NOTIFY_CONCURRENCY)
+    async def one(r):
+        text = (f"✅ Your withdraw #{r['id']} approved. Amount: {micro_to_usd(r['amount_micro'])}" if status == "approved"
+                else f"❌ Your withdraw #{r['id']} was rejected.")
+        async with sem:
+            return await tg_sender.send(bot, r["user_id"], text)
+    results = Counter(await asyncio.gather(*(one(r) for r in rows)))
+    if len(rows) > 1:
+        print(f"Withdraw notices ({status}): {dict(results)}")
+
+def notify_withdraws(bot, rows, status:str):
+    return start_background(_send_withdraw_notices(bot, rows, status), f"withdraw-notify-{status}")
+
+async def approve_withdraws_bulk(bot, after_id:int, max_id:int, max_amount_micro:Optional[int]=None):
+    # settles every matching pending request in (after_id, max_id], WITHDRAW_BULK_MAX per transaction
+    # -> (approved rows, rows left pending because the user's balance doesn't cover them)
+    settled = []; uncovered = []
+    while after_id is not None:
+        done, short, after_id = await aapprove_withdraws(after_id, max_id, max_amount_micro, WITHDRAW_BULK_MAX)
+        settled += done; uncovered += short
+    if settled: notify_withdraws(bot, settled, "approved")
+    return settled, uncovered
+
+def _approved_note(done, short, what:str="withdraws") -> str:
+    note = f"✅ Approved {len(done)} {what} ({micro_to_usd(sum(r['amount_micro'] for r in done))})."
+    if short:
+        ids = ", ".join(f"#{r['id']}" for r in short[:10]) + (" …" if len(short) > 10 else "")
+        note += f"\n⚠️ {len(short)} left pending, balance doesn't cover them: {ids}"
+    return note
+
+def _age(ts:int) -> str:
+    secs = max(0, int(time.time()) - (ts or 0))
+    if secs < 3600: return f"{secs // 60}m"
+    if secs < 86400: return f"{secs // 3600}h"
+    return f"{secs // 86400}d"
+
+async def withdraw_queue_view(after_id:int, note:str=""):
+    # -> (text, markup) for the page of pending withdraws after after_id
+    rows = await apending_withdraws_page(after_id, WITHDRAW_PAGE_SIZE + 1)
+    has_next = len(rows) > WITHDRAW_PAGE_SIZE; rows = rows[:WITHDRAW_PAGE_SIZE]
+    st = await aget_stats()
+    head = f"💸 Pending withdraws: {st.get('withdraws_pending', 0)} ({micro_to_usd(st.get('withdraws_pending_micro', 0))})"
+    lines = [note, head] if note else [head]
+    kb = []
+    if not rows:
+        lines.append("Nothing pending here.")
+    else:
+        page_total = sum(r["amount_micro"] for r in rows)
+        lines.append(f"#{rows[0]['id']}–#{rows[-1]['id']}:")
+        for r in rows:
+            lines.append(f"#{r['id']} · user {r['user_id']} · {micro_to_usd(r['amount_micro'])} · {_age(r['requested_at'])} ago")
+            kb.append([InlineKeyboardButton(f"✅ #{r['id']}", callback_data=f"wqy:{r['id']}:{after_id}"),
+                       InlineKeyboardButton(f"❌ #{r['id']}", callback_data=f"wqn:{r['id']}:{after_id}")])
+        kb.append([InlineKeyboardButton(f"✅ Approve page ({len(rows)}, {micro_to_usd(page_total)})",
+                                        callback_data=f"wqa:{after_id}:{rows[-1]['id']}")])
+    under = int(round(WITHDRAW_BULK_UNDER_USD * 1000))
+    if st.get("withdraws_pending", 0):
+        kb.append([InlineKeyboardButton(f"Approve all ≤ {micro_to_usd(under)}", callback_data=f"wqu:{under}")])
+    nav = []
+    if after_id: nav.append(InlineKeyboardButton("⏮ First", callback_data="wq:0"))
+    if has_next: nav.append(InlineKeyboardButton("Next ▶", callback_data=f"wq:{rows[-1]['id']}"))
+    if nav: kb.append(nav)
+    kb.append([InlineKeyboardButton("🛠 Admin Panel", callback_data="admin_panel")])
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+async def on_withdraw_queue(query, context):
+    action, *args = query.data.split(":")
+    args = [int(a) for a in args]
+    note = ""; after_id = 0
+    if action == "wq":
+        after_id = args[0]
+    elif action == "wqa":
+        # approve exactly the page that was shown: pending ids in (after_id, last_id]
+        after_id, last_id = args
+        note = _approved_note(*await approve_withdraws_bulk(context.bot, after_id, last_id))
+    elif action in ("wqy", "wqn"):
+        wid, after_id = args
+        r = await (aapprove_withdraw(wid) if action == "wqy" else areject_withdraw(wid))
+        if r and r.get("approved") is False:
+            note = f"⚠️ #{wid} left pending: the user's balance doesn't cover it."
+        else:
+            if r: notify_withdraws(context.bot, [r], "approved" if action == "wqy" else "rejected")
+            note = (f"{'✅ Approved' if action == 'wqy' else '❌ Rejected'} #{wid}." if r else f"#{wid} was already processed.")
+    elif action == "wqu":
+        # ask first: show what "all under $X" covers, capped at the current highest id
+        under = args[0]
+        n, total, top = await apending_withdraws_summary(None, under)
+        if not n:
+            note = f"No pending withdraws ≤ {micro_to_usd(under)}."
+        else:
+            kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"✅ Approve {n} ({micro_to_usd(total)})", callback_data=f"wquy:{under}:{top}")],
+                                       [InlineKeyboardButton("Cancel", callback_data="wq:0")]])
+            await query.edit_message_text(f"Approve all {n} pending withdraws ≤ {micro_to_usd(under)}, total {micro_to_usd(total)}?", reply_markup=kb)
+            return
+    elif action == "wquy":
+        under, top = args
+        note = _approved_note(*await approve_withdraws_bulk(context.bot, 0, top, under), f"withdraws ≤ {micro_to_usd(under)}")
+    text, kb = await withdraw_queue_view(after_id, note)
+    await query.edit_message_text(text, reply_markup=kb)
+
 # -------------------------
 # Telegram handlers
 # -------------------------
+@track_api_calls
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     args = context.args or []
@@ -329,28 +2879,28 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             referred_by = None
 
-    ensure_user(user.id, user.username or "")
-    # handle referral once (we simply credit referrer on /start with ref id; in production, ensure one-time only)
-    if referred_by:
-        # only credit if referrer exists and not self and referrer not previously counted
-        r = get_user(referred_by)
-        if r:
-            add_referral_for(referred_by)
-            credit(referred_by, REFERRAL_BONUS_MICRO, field="referral_balance_micro", add_total=True, tx_type="referral")
+    # the referral (edge, counters, bonus) is recorded with the new user row: once, and only for new users
+    await aensure_user(user.id, user.username or "", referred_by)
 
-    row = get_user(user.id)
+    row = await aget_user(user.id)
     bal = row["balance_micro"] if row else 0
     text = (f"👋 Hello {user.first_name}!\n\n"
             f"Total Balance: {micro_to_usd(bal)}\n\n"
             "Choose an action below:")
     await update.message.reply_text(text, reply_markup=make_user_keyboard(user.id))
 
+@track_api_calls
 async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     user = query.from_user
     uid = user.id
-    ensure_user(uid, user.username or "")
+    if uid != ADMIN_ID and not callback_limiter.hit(uid):
+        # no DB work and no message edit for a flood, just the answer
+        note_velocity(uid, "rate_limited")
+        await query.answer("Too many taps, slow down.")
+        return
+    await query.answer()
+    await aensure_user(uid, user.username or "")
 
     # WATCH AD -> generate token & send link + I watched button
     if query.data == "watch_ad":
@@ -368,23 +2918,27 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Confirm ad after watching
     if query.data and query.data.startswith("confirm_ad:"):
         token = query.data.split(":",1)[1]
-        click = get_click(uid, token)
-        if not click:
+        # credit 80% of AD_REWARD_MICRO to user's ad_balance
+        user_share = int(round(AD_REWARD_MICRO * 0.80))
+        click_ts = await click_store.get(uid, token)
+        if click_ts is None:
+            note_velocity(uid, "bad_token")
             await query.edit_message_text("❌ Could not verify click. Use the *Open Ad (tracking)* button first.", reply_markup=make_user_keyboard(uid))
             return
-        elapsed = int(time.time()) - click["ts"]
-        if elapsed < WAIT_SECONDS:
-            await query.edit_message_text(f"⏳ You waited {elapsed}s. You must wait {WAIT_SECONDS}s before claiming.", reply_markup=make_user_keyboard(uid))
+        status, value = await aclaim_ad(uid, token, click_ts, WAIT_SECONDS, MAX_ADS_PER_DAY, user_share)
+        if status in ("ok", "claimed"):
+            click_store.discard(uid, token)
+        note_velocity(uid, {"ok": "claim", "claimed": "replay", "wait": "early_confirm"}.get(status, "claim"))
+        if status == "claimed":
+            await query.edit_message_text("❌ This ad was already claimed.", reply_markup=make_user_keyboard(uid))
+            return
+        if status == "wait":
+            await query.edit_message_text(f"⏳ You waited {value}s. You must wait {WAIT_SECONDS}s before claiming.", reply_markup=make_user_keyboard(uid))
             return
-        if not can_watch_more_ads(uid, MAX_ADS_PER_DAY):
+        if status == "limit":
             await query.edit_message_text(f"⚠️ Daily ad limit reached ({MAX_ADS_PER_DAY}).", reply_markup=make_user_keyboard(uid))
             return
-        # credit 80% of AD_REWARD_MICRO to user's ad_balance
-        user_share = int(round(AD_REWARD_MICRO * 0.80))
-        credit(uid, user_share, field="ad_balance_micro", add_total=True, tx_type="ad")
-        inc_ads_today(uid)
-        row = get_user(uid)
-        await query.edit_message_text(f"✅ You earned {micro_to_usd(user_share)} for watching the ad.\nTotal: {micro_to_usd(row['balance_micro'])}", reply_markup=make_user_keyboard(uid))
+        await query.edit_message_text(f"✅ You earned {micro_to_usd(user_share)} for watching the ad.\nTotal: {micro_to_usd(value)}", reply_markup=make_user_keyboard(uid))
         return
 
     # Offerwall: open direct link with subid
@@ -398,27 +2952,26 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Daily bonus
     if query.data == "daily_bonus":
-        if has_claimed_daily(uid):
+        bal = await aclaim_daily_bonus(uid, DAILY_BONUS_MICRO)
+        if bal is None:
             await query.edit_message_text("❌ You already claimed today's bonus.", reply_markup=make_user_keyboard(uid))
             return
-        credit(uid, DAILY_BONUS_MICRO, field="balance_micro", add_total=True, tx_type="bonus")
-        set_daily_bonus_claimed(uid)
-        row = get_user(uid)
-        await query.edit_message_text(f"🎁 Daily bonus credited {micro_to_usd(DAILY_BONUS_MICRO)}\nTotal: {micro_to_usd(row['balance_micro'])}", reply_markup=make_user_keyboard(uid))
+        await query.edit_message_text(f"🎁 Daily bonus credited {micro_to_usd(DAILY_BONUS_MICRO)}\nTotal: {micro_to_usd(bal)}", reply_markup=make_user_keyboard(uid))
         return
 
     # Referrals screen
     if query.data == "referrals":
-        row = get_user(uid)
-        rc = row["referrals_count"] if row else 0
-        bot_username = (await context.bot.get_me()).username
+        direct, depth2, earned = await aget_referral_stats(uid)
+        bot_username = (await context.bot.get_me()).username  # cached by EarnlyBot
         link = f"https://t.me/{bot_username}?start={uid}"
-        await query.edit_message_text(f"👥 Your referral link:\n{link}\n\nReferrals: {rc}\nBonus: {micro_to_usd(REFERRAL_BONUS_MICRO)} each", reply_markup=make_user_keyboard(uid))
+        await query.edit_message_text(f"👥 Your referral link:\n{link}\n\nReferrals: {direct}\nTheir referrals: {depth2}\n"
+                                      f"Earned by your referrals: {micro_to_usd(earned)}\nBonus: {micro_to_usd(REFERRAL_BONUS_MICRO)} each",
+                                      reply_markup=make_user_keyboard(uid))
         return
 
     # Balance screen (show breakdown + total)
     if query.data == "balance":
-        row = get_user(uid)
+        row = await aget_user(uid)
         if not row:
             await query.edit_message_text("0 balance", reply_markup=make_user_keyboard(uid)); return
         total = row["balance_micro"]
@@ -435,12 +2988,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Withdraw request
     if query.data == "withdraw":
-        row = get_user(uid)
+        row = await aget_user(uid)
         bal = row["balance_micro"] if row else 0
         if bal < WITHDRAW_MIN_MICRO:
             await query.edit_message_text(f"💳 Withdraw requires minimum {micro_to_usd(WITHDRAW_MIN_MICRO)}. Your total: {micro_to_usd(bal)}", reply_markup=make_user_keyboard(uid))
             return
-        wid = add_withdraw_request(uid, bal)
+        wid = await aadd_withdraw_request(uid, bal)
         await query.edit_message_text(f"✅ Withdraw request #{wid} submitted for {micro_to_usd(bal)}. Admin will review.", reply_markup=make_user_keyboard(uid))
         # notify admin with approve/reject buttons
         kb = InlineKeyboardMarkup([
@@ -456,13 +3009,11 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Admin approve/reject actions
     if query.data and query.data.startswith("approve_withdraw:") and query.from_user.id == ADMIN_ID:
         wid = int(query.data.split(":")[1])
-        ok = approve_withdraw(wid)
-        if ok:
-            conn = get_conn(); cur = conn.cursor()
-            cur.execute("SELECT user_id, amount_micro FROM withdraws WHERE id = ?", (wid,))
-            r = cur.fetchone(); conn.close()
-            if r:
-                await context.bot.send_message(r["user_id"], f"✅ Your withdraw #{wid} approved. Amount: {micro_to_usd(r['amount_micro'])}")
+        r = await aapprove_withdraw(wid)
+        if r and not r["approved"]:
+            await query.edit_message_text(f"⚠️ Withdraw #{wid} left pending: the user's balance doesn't cover it.")
+        elif r:
+            notify_withdraws(context.bot, [r], "approved")
             await query.edit_message_text("✅ Withdraw approved.")
         else:
             await query.edit_message_text("❌ Could not approve (maybe processed).")
@@ -470,21 +3021,22 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data and query.data.startswith("reject_withdraw:") and query.from_user.id == ADMIN_ID:
         wid = int(query.data.split(":")[1])
-        reject_withdraw(wid)
-        conn = get_conn(); cur = conn.cursor()
-        cur.execute("SELECT user_id, amount_micro FROM withdraws WHERE id = ?", (wid,))
-        r = cur.fetchone(); conn.close()
+        r = await areject_withdraw(wid)
         if r:
-            await context.bot.send_message(r["user_id"], f"❌ Your withdraw #{wid} was rejected.")
-        await query.edit_message_text("❌ Withdraw rejected.")
+            notify_withdraws(context.bot, [r], "rejected")
+            await query.edit_message_text("❌ Withdraw rejected.")
+        else:
+            await query.edit_message_text("❌ Could not reject (maybe processed).")
+        return
+
+    # Withdraw review queue (wq*: page / approve page / approve under $X / per-row)
+    if query.data and query.data.startswith("wq") and query.from_user.id == ADMIN_ID:
+        await on_withdraw_queue(query, context)
         return
 
     # Leaderboard
     if query.data == "leaderboard":
-        rows = top_users(10)
-        text = "🏆 Leaderboard\n\n"
-        for i, r in enumerate(rows, start=1):
-            text += f"{i}. {r['user_id']} — {micro_to_usd(r['balance_micro'])}\n"
+        text = await leaderboard_text()
         await query.edit_message_text(text, reply_markup=make_user_keyboard(uid))
         return
 
@@ -495,14 +3047,27 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Admin panel simple view
     if query.data == "admin_panel" and query.from_user.id == ADMIN_ID:
-        pending = get_pending_withdraws()
-        text = f"🛠 Admin Panel\nPending withdraws: {len(pending)}\nTotal users: {total_users()}"
-        await query.edit_message_text(text)
+        st = await aget_stats()
+        text = (f"🛠 Admin Panel\nPending withdraws: {st.get('withdraws_pending', 0)} "
+                f"({micro_to_usd(st.get('withdraws_pending_micro', 0))})\nTotal users: {st.get('users', 0)}")
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("💸 Review withdraws", callback_data="wq:0")]])
+        await query.edit_message_text(text, reply_markup=kb)
         return
 
     await query.edit_message_text("Unknown action. Returning to menu.", reply_markup=make_user_keyboard(uid))
 
 # Admin commands
+def daily_breakdown(days) -> str:
+    # "last 7 days" block of /admin_stats: one line per day, earnings per transaction type
+    lines = ["Last 7 days (UTC):"]
+    for day, types in days.items():
+        total = sum(a for t, (_, a) in types.items() if t != "withdraw")   # earned; payouts listed separately
+        parts = ", ".join(f"{t} {n}× {micro_to_usd(a)}" for t, (n, a) in types.items())
+        lines.append(f" {day}: {micro_to_usd(total)} ({parts})")
+    if not days: lines.append(" no transactions")
+    return "\n".join(lines)
+
+@track_api_calls
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Not allowed.")
@@ -511,29 +3076,115 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         await update.message.reply_text("Usage: /admin_broadcast <message>")
         return
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users"); rows = cur.fetchall(); conn.close()
-    sent = 0
-    for r in rows:
-        try:
-            await context.bot.send_message(r["user_id"], text)
-            sent += 1
-        except:
-            pass
-    await update.message.reply_text(f"Broadcast sent to {sent} users.")
+    total = await atotal_users()
+    bid = await acreate_broadcast(text, update.effective_chat.id, total)
+    msg = await update.message.reply_text(f"📣 Broadcast #{bid} queued for {total} users.")
+    await aset_broadcast_message(bid, msg.message_id)
+    if leader.held:
+        start_broadcast_task(context.bot, bid)
+    # otherwise the leader worker picks it up within LEADER_POLL_SECONDS
+
+@track_api_calls
+async def admin_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Not allowed.")
+        return
+    try:
+        bid = int(context.args[0])
+    except (IndexError, ValueError, TypeError):
+        await update.message.reply_text("Usage: /admin_broadcast_cancel <id>")
+        return
+    ok = await afinish_broadcast(bid, "cancelled")
+    task = _broadcast_tasks.pop(bid, None)
+    if task: task.cancel()
+    await update.message.reply_text(f"Broadcast #{bid} cancelled." if ok else f"Broadcast #{bid} is not running.")
 
+@track_api_calls
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Not allowed.")
         return
-    users = total_users()
-    pending = len(get_pending_withdraws())
-    await update.message.reply_text(f"Total users: {users}\nPending withdraws: {pending}")
+    st = await aget_stats()
+    ws = db_writer.stats(); uc = user_cache.stats(); wi = webhook_ingest.stats(); cs = click_store.stats()
+    rl = {name: lim.stats()["rejected"] for name, lim in (("/v user", v_user_limiter), ("/v ip", v_ip_limiter), ("buttons", callback_limiter))}
+    await update.message.reply_text(f"Total users: {st.get('users', 0)}\n"
+                                    f"Pending withdraws: {st.get('withdraws_pending', 0)} ({micro_to_usd(st.get('withdraws_pending_micro', 0))}), "
+                                    f"approved {st.get('withdraws_approved', 0)} ({micro_to_usd(st.get('withdraws_approved_micro', 0))}), "
+                                    f"rejected {st.get('withdraws_rejected', 0)}\n"
+                                    f"{daily_breakdown(await adaily_stats(7))}\n"
+                                    f"DB writer: {ws['batches']} batches, avg {ws['avg_batch']} / max {ws['max_batch']} ops, "
+                                    f"queue {ws['queue_depth']} (max {ws['max_queue_depth']}), last commit {ws['last_commit_ms']}ms\n"
+                                    f"User cache: {uc['size']} rows, {uc['hits']} hits / {uc['misses']} misses ({uc['hit_rate']:.0%}), "
+                                    f"{uc['evictions']} evictions, {uc['expirations']} expired\n"
+                                    f"Bot API calls: {dict(api_stats.calls.most_common(6))}, saved {sum(api_stats.saved.values())}\n"
+                                    f"API calls/update: {api_stats.calls_per_update()}\n"
+                                    f"Webhook: {wi['received']} received, {wi['duplicates']} duplicates, {wi['dropped']} dropped, {wi['pending']} pending\n"
+                                    f"Click tokens: {cs['size']} live, {cs['hits']} hits / {cs['misses']} misses ({cs['db_hits']} from DB)\n"
+                                    f"Rate limited: {rl}\n"
+                                    f"Flagged users (latest): {velocity.stats()['flagged'] or 'none'}")
+
+@track_api_calls
+async def admin_approve_under(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Not allowed.")
+        return
+    try:
+        under = int(round(float(context.args[0].lstrip("$")) * 1000))
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /admin_approve_under <usd>   e.g. /admin_approve_under 5")
+        return
+    _, _, top = await apending_withdraws_summary()
+    note = _approved_note(*await approve_withdraws_bulk(context.bot, 0, top, under), f"withdraws ≤ {micro_to_usd(under)}")
+    await update.message.reply_text(note + "\nUsers are being notified.")
+
+@track_api_calls
+async def admin_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Not allowed.")
+        return
+    repair = bool(context.args) and context.args[0] == "repair"
+    r = await reconcile(repair=repair)
+    lines = [f"🧾 Reconciliation: {r['checked']} users checked, {r['folded']} new ledger rows folded in {r['seconds']}s"]
+    if not r["drifted"]:
+        lines.append("✅ Balances match the ledger.")
+    else:
+        lines.append(f"⚠️ {r['drifted']} users drift from the ledger" + (f", {r['repaired']} repaired." if repair else ". Run /admin_reconcile repair to fix."))
+        lines += [f" {col}: {micro_to_usd(d)} (ledger − stored)" for col, d in r["per_column"].items()]
+        lines += [f" user {u}: {col} {stored} → ledger {expected}" for u, col, stored, expected in r["samples"]]
+    if r["orphans"]:
+        lines.append(f"Ledger rows for {r['orphans']} unknown users ({micro_to_usd(r['orphan_micro'])}).")
+    await update.message.reply_text("\n".join(lines))
+
+@track_api_calls
+async def admin_rebuild_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Not allowed.")
+        return
+    r = await rebuild_referrals()
+    await update.message.reply_text(f"👥 Referral stats rebuilt: {r['referrers']} referrers, {r['changed']} rows corrected in {r['seconds']}s")
+
+@track_api_calls
+async def admin_leaderboard_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Not allowed.")
+        return
+    ok, cached, db = await check_leaderboard()
+    if ok:
+        await update.message.reply_text(f"✅ Leaderboard cache matches the DB ({len(db)} entries, {leaderboard.reseeds} seeds).")
+        return
+    diff = [f"#{i}: cache {c} / db {d}" for i, (c, d) in enumerate(zip(cached + [None] * len(db), db), start=1) if c != d]
+    await update.message.reply_text("⚠️ Leaderboard cache drifted, reseeded.\n" + "\n".join(diff[:10]))
 
 # -------------------------
 # Run uvicorn if __main__
 # -------------------------
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["check-plans"]:
+        # migrate, then fail (exit 1) if any hot query falls back to a scan
+        migrate()
+        problems = check_query_plans()
+        for p in problems: print("SCAN:", p)
+        sys.exit(1 if problems else 0)
     init_db()
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")))